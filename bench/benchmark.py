@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks of the matchers and the changeset processing.
+
+Synthetic changesets of --paths paths and --biffs biffs are generated with
+a fixed seed, so the results are reproducible on the same machine. Each
+case runs in a forked process and reports the throughput and how much
+the case raised the peak memory of the process. With --check, it exits
+with 1 when a throughput is lower than the threshold in thresholds.json.
+
+    $ python bench/benchmark.py --paths 20000 --biffs 300 --check
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from changefilebiff import matcher  # noqa
+
+THRESHOLDS = os.path.join(os.path.dirname(__file__), 'thresholds.json')
+
+DIRS = ['src', 'lib', 'docs', 'tests', 'vendor', 'tools', 'api', 'web']
+EXTS = ['py', 'js', 'txt', 'png', 'jpg', 'html', 'css', 'c', 'h', 'java',
+        'properties', 'xml', 'json', 'md', 'rst', 'gif', 'yml', 'sql']
+
+
+def generate_paths(rand, count):
+    paths = []
+    for i in range(count):
+        depth = rand.randint(1, 6)
+        dirs = [rand.choice(DIRS) + str(rand.randint(0, 9))
+                for __ in range(depth)]
+        name = '%s_%d.%s' % (rand.choice(['test', 'main', 'util', 'model']),
+                             i, rand.choice(EXTS))
+        paths.append('/'.join(dirs + [name]))
+    return paths
+
+
+def generate_fnmatch_biffs(rand, count):
+    """Mix of extensions, exact names and other globs like real ones."""
+    biffs = []
+    for i in range(count):
+        patterns = []
+        for __ in range(rand.randint(1, 4)):
+            kind = rand.random()
+            if kind < 0.6:
+                patterns.append('*.' + rand.choice(EXTS) + str(i % 3 or ''))
+            elif kind < 0.8:
+                patterns.append('Makefile%d' % i)
+            else:
+                patterns.append('%s_%d?.%s' % (rand.choice(['test', 'util']),
+                                               i, rand.choice(EXTS)))
+        biffs.append(('%016x' % i, patterns))
+    return biffs
+
+
+def generate_gitignore_biffs(rand, count):
+    """Mix of extensions, deep globs and negations."""
+    biffs = []
+    for i in range(count):
+        dir_ = rand.choice(DIRS) + str(rand.randint(0, 9))
+        ext = rand.choice(EXTS)
+        kind = rand.random()
+        if kind < 0.4:
+            patterns = ['*.%s' % ext]
+        elif kind < 0.8:
+            patterns = ['%s/**/test_*.%s' % (dir_, ext)]
+        else:
+            patterns = ['*.%s' % ext, '!%s/' % dir_]
+        biffs.append(('%016x' % i, patterns))
+    return biffs
+
+
+def generate_regex_biffs(rand, count):
+    """Mix of extensions, directories and anchored paths."""
+    biffs = []
+    for i in range(count):
+        patterns = []
+        for __ in range(rand.randint(1, 3)):
+            dir_ = rand.choice(DIRS) + str(rand.randint(0, 9))
+            kind = rand.random()
+            if kind < 0.5:
+                patterns.append(r'\.%s%s$' % (rand.choice(EXTS), i % 3 or ''))
+            elif kind < 0.8:
+                patterns.append(r'(?:^|/)%s/' % dir_)
+            else:
+                patterns.append(r'^%s/.*_%d\.%s$'
+                                % (dir_, i, rand.choice(EXTS)))
+        biffs.append(('%016x' % i, patterns))
+    return biffs
+
+
+def peak_memory():
+    """Peak resident set size in KiB (bytes on Mac OS X)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_case(name, func, units, repeat, check=None):
+    """Run func repeat times in a forked process, then check() if given.
+
+    The peak memory of a process never decreases, so each case gets a new
+    process starting from the peak of the parent at the fork.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            base = peak_memory()
+            timings = []
+            for __ in range(repeat):
+                start = time.time()
+                func()
+                timings.append(time.time() - start)
+            if check:
+                check()
+            result = [min(timings), peak_memory() - base, None]
+        except BaseException as e:
+            result = [None, None, '%s: %s' % (e.__class__.__name__, e)]
+            status = 1
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(result, f)
+        os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        best, memory, error = json.load(f)
+    os.waitpid(pid, 0)
+    if error:
+        raise AssertionError('%s failed: %s' % (name, error))
+    throughput = units / best if best else float('inf')
+    print('%-24s %10.3f s %14.0f paths/s %10d KiB'
+          % (name, best, throughput, memory))
+    return throughput
+
+
+def bench_matchers(args, rand, paths):
+    results = {}
+    fnmatch_biffs = generate_fnmatch_biffs(rand, args.biffs)
+
+    # the baselines scan all paths for each biff like the indexes do
+    def fnmatch_per_biff():
+        fnmatch_matcher = matcher.FnmatchMatcher()
+        for __, patterns in fnmatch_biffs:
+            list(fnmatch_matcher.match_files(patterns, paths))
+
+    def fnmatch_index():
+        index = matcher.FnmatchMatcher().compile(fnmatch_biffs)
+        index.match_files(paths)
+
+    units = len(paths)
+    results['fnmatch_per_biff'] = run_case('fnmatch_per_biff',
+                                           fnmatch_per_biff, units,
+                                           args.repeat)
+    results['fnmatch_index'] = run_case('fnmatch_index', fnmatch_index,
+                                        units, args.repeat)
+
+    regex_biffs = generate_regex_biffs(rand, args.biffs)
+
+    def regex_per_biff():
+        regex_matcher = matcher.RegexMatcher()
+        for __, patterns in regex_biffs:
+            list(regex_matcher.match_files(patterns, paths))
+
+    def regex_index():
+        index = matcher.RegexMatcher().compile(regex_biffs)
+        index.match_files(paths)
+
+    results['regex_per_biff'] = run_case('regex_per_biff', regex_per_biff,
+                                         units, args.repeat)
+    results['regex_index'] = run_case('regex_index', regex_index,
+                                      units, args.repeat)
+
+    if matcher.have_pathspec:
+        gitignore_biffs = generate_gitignore_biffs(rand, args.biffs)
+
+        def gitignore_index():
+            matcher.GitIgnoreMatcher.clear_cache()
+            index = matcher.GitIgnoreMatcher().compile(gitignore_biffs)
+            index.match_files(paths)
+
+        results['gitignore_index'] = run_case(
+            'gitignore_index', gitignore_index,
+            len(paths), args.repeat)
+    else:
+        print('gitignore_index          skipped, pathspec is not installed')
+    return results
+
+
+def check_upgrade(env):
+    """Upgrade the environment from no schema to the latest one."""
+    from changefilebiff import db_default
+    from changefilebiff.api import ChangefileBiffModule
+
+    module = ChangefileBiffModule(env)
+    module.upgrade_environment(None)
+    version = module._get_schema_version()
+    if version != db_default.version:
+        raise AssertionError('schema version %d is not %d'
+                             % (version, db_default.version))
+    for tables in db_default.tables.values():
+        for table in tables:
+            env.db_query("SELECT COUNT(*) FROM %s" % table.name)
+    env.db_query("SELECT %s FROM filebiff"
+                 % ','.join(('id', 'name', 'cc', 'filename', 'repository')))
+
+
+class Changeset(object):
+
+    def __init__(self, rev, paths, message, date):
+        self.rev = rev
+        self.paths = paths
+        self.message = message
+        self.author = 'admin'
+        self.date = date
+
+    def get_changes(self):
+        for path in self.paths:
+            yield path, 'file', 'edit', path, self.rev - 1
+
+
+class Repository(object):
+
+    reponame = ''
+
+
+def bench_changesets(args, rand, paths):
+    from trac.test import EnvironmentStub
+    from trac.ticket import Ticket
+    from trac.util.datefmt import utc
+    from tracopt.ticket.commit_updater import CommitTicketUpdater
+
+    from changefilebiff.api import ChangefileBiffRepositoryChangeListener
+    from changefilebiff.model import ChangefileBiffConfig
+
+    env = EnvironmentStub(default_data=True,
+                          enable=['trac.*', 'changefilebiff.*',
+                                  'tracopt.ticket.commit_updater.*'])
+    env.config.set('ticket', 'commit_ticket_update_check_perms', 'false')
+    try:
+        check_upgrade(env)
+        # listeners are instantiated by RepositoryManager.notify in Trac
+        CommitTicketUpdater(env)
+        biff_config = ChangefileBiffConfig(env, env.config)
+        for key, patterns in generate_fnmatch_biffs(rand, args.biffs):
+            biff_config.add({'name': 'biff-' + key, 'cc': '',
+                             'filename': u', '.join(patterns)})
+
+        tkt_ids = []
+        for i in range(args.tickets):
+            ticket = Ticket(env)
+            ticket.populate({'summary': 'ticket %d' % i, 'reporter': 'admin',
+                             'status': 'new'})
+            tkt_ids.append(ticket.insert())
+
+        message = 'Refs %s' % ', '.join('#%d' % id_ for id_ in tkt_ids)
+        changesets = [Changeset(rev, paths[rev::args.changesets], message,
+                                datetime.now(utc))
+                      for rev in range(1, args.changesets + 1)]
+        listener = ChangefileBiffRepositoryChangeListener(env)
+        repos = Repository()
+
+        def process():
+            for changeset in changesets:
+                listener.changeset_added(repos, changeset)
+
+        def check():
+            # the database of the forked process is checked
+            for tkt_id in tkt_ids:
+                if not Ticket(env, tkt_id)['filebiff']:
+                    raise AssertionError('ticket #%d is not updated' % tkt_id)
+
+        return {'changeset_added': run_case('changeset_added', process,
+                                            len(paths), 1, check)}
+    finally:
+        env.reset_db()
+
+
+def check_thresholds(results):
+    with open(THRESHOLDS) as f:
+        thresholds = json.load(f)
+
+    failed = False
+    for name, minimum in sorted(thresholds.items()):
+        if name in results and results[name] < minimum:
+            print('REGRESSION: %s %.0f paths/s is lower than %.0f'
+                  % (name, results[name], minimum))
+            failed = True
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--paths', type=int, default=10000)
+    parser.add_argument('--biffs', type=int, default=200)
+    parser.add_argument('--changesets', type=int, default=10)
+    parser.add_argument('--tickets', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-trac', action='store_true',
+                        help='skip the changeset processing with Trac')
+    parser.add_argument('--check', action='store_true',
+                        help='fail when a throughput is below thresholds')
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    paths = generate_paths(rand, args.paths)
+    print('%d paths, %d biffs' % (args.paths, args.biffs))
+
+    results = bench_matchers(args, rand, paths)
+    if not args.no_trac:
+        results.update(bench_changesets(args, rand, paths))
+
+    if args.check and not check_thresholds(results):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,35 @@
 # -*- coding: utf-8 -*-
+import json
 import re
+import sys
+import time
+from getpass import getuser
 from pkg_resources import resource_filename
 from string import whitespace
 
-from trac.admin.api import IAdminPanelProvider
-from trac.core import Component, implements
+from trac.admin.api import IAdminCommandProvider, IAdminPanelProvider
+from trac.config import IntOption
+from trac.core import Component, TracError, implements
+from trac.util.datefmt import from_utimestamp, pretty_timedelta
+from trac.util.datefmt import to_utimestamp
+from trac.util.presentation import Paginator
+from trac.util.text import print_table, printout
 from trac.util.translation import dgettext
+from trac.versioncontrol.api import RepositoryManager
 from trac.web.chrome import ITemplateProvider
-from trac.web.chrome import add_notice, add_warning
+from trac.web.chrome import add_link, add_notice, add_warning
 
 from api import _
+from api import ChangefileBiffRepositoryChangeListener
 from model import ChangefileBiffConfig
+from model import BiffHits
+from model import BiffSnapshot
+from model import ChangesetQueue
+from model import DEFAULT_REPOSITORY, split_values
+from matcher import RegexMatcher
+from stats import LATENCY_BUCKETS, ChangefileBiffStats
 
-__all__ = ['ChangefileBiffAdminPage']
+__all__ = ['ChangefileBiffAdminCommand', 'ChangefileBiffAdminPage']
 
 WHITESPACE_PATTERN = re.compile(u'|'.join(whitespace), re.U)
 
@@ -21,6 +38,20 @@ class ChangefileBiffAdminPage(Component):
 
     implements(IAdminPanelProvider, ITemplateProvider)
 
+    known_users_ttl = IntOption(
+        'changefilebiff', 'known_users_ttl', 300,
+        """Seconds to cache the known users for the validation of Cc on
+        the admin page. A user not in the cache is checked again with the
+        fresh known users.""")
+
+    items_per_page = IntOption(
+        'changefilebiff', 'admin_items_per_page', 100,
+        """Number of File Biff settings shown in a page of the admin
+        page.""")
+
+    def __init__(self):
+        self._known_users = None  # (loaded time, frozenset of users)
+
     # IAdminPanelProvider methods
     def get_admin_panels(self, req):
         if 'TICKET_ADMIN' in req.perm:
@@ -65,21 +96,88 @@ class ChangefileBiffAdminPage(Component):
                 else:
                     add_warning(req, _('No Biff configuration selected.'))
 
-        biff_values = biff_config.biff.values()
-        return template, {'view': 'list',
-                          'biff': biff_config.get_i18n_message_catalog(),
-                          'biff_values': biff_values}
+        query = req.args.get('q', '').strip()
+        sort = req.args.get('sort', 'name')
+        asc = req.args.get('asc', '1') != '0'
+        try:
+            page_num = max(1, int(req.args.get('page', 1)))
+            max_per_page = max(1, int(req.args.get('max',
+                                                   self.items_per_page)))
+        except ValueError:
+            raise TracError(_('Invalid page or max'))
+        biff_values = biff_config.snapshot.search(query, sort, asc)
+        paginator = Paginator(biff_values, page_num - 1, max_per_page)
+
+        hits = BiffHits(self.env).get_totals()
+        if req.args.get('format') == 'json':
+            self._send_json(req, paginator, hits)
+
+        # e.g. the settings added before changing the matching pattern
+        snapshot = biff_config.snapshot
+        for key, pattern, error in snapshot.get_index(self.env,
+                                                      cached=False).invalid:
+            add_warning(req, _("The pattern '%(pattern)s' of File Biff "
+                               "'%(name)s' is ignored: %(error)s",
+                               pattern=pattern,
+                               name=snapshot.biff[key]['name'], error=error))
+
+        def href(**kwargs):
+            args = {'q': query or None, 'sort': sort, 'asc': int(asc),
+                    'max': max_per_page}
+            args.update(kwargs)
+            return req.href.admin(cat, page, **args)
+
+        if paginator.has_next_page:
+            add_link(req, 'next', href(page=page_num + 1), _('Next Page'))
+        if paginator.has_previous_page:
+            add_link(req, 'prev', href(page=page_num - 1), _('Previous Page'))
+        paginator.shown_pages = [
+            {'href': href(page=num), 'class': None, 'string': str(num),
+             'title': _('Page %(num)d', num=num)}
+            for num in paginator.get_shown_pages(21)]
+        paginator.current_page = {'href': None, 'class': 'current',
+                                  'string': str(paginator.page + 1),
+                                  'title': None}
+
+        data = {'view': 'list',
+                'biff': biff_config.get_i18n_message_catalog(),
+                'biff_values': paginator,
+                'paginator': paginator,
+                'hits': hits,
+                'query': query, 'sort': sort, 'asc': asc,
+                'sort_href': lambda field: href(
+                    sort=field, asc=int(not asc if field == sort else True),
+                    page=None)}
+        stats = ChangefileBiffStats(self.env)
+        if stats.enabled:
+            data['stats_counters'] = stats.get_counters()
+            data['stats_latencies'] = stats.get_latencies()
+            data['format_bound'] = _format_bound
+        return template, data
+
+    def _send_json(self, req, paginator, hits):
+        fields = ('key',) + BiffSnapshot.SORT_FIELDS
+        biffs = []
+        for biff in paginator:
+            values = dict((field, biff.get(field) or '') for field in fields)
+            count, last_hit = hits.get(biff['key'], (0, None))
+            values['hits'] = count
+            values['last_hit'] = last_hit and to_utimestamp(last_hit)
+            biffs.append(values)
+        req.send(json.dumps({
+            'total': paginator.num_items,
+            'page': paginator.page + 1,
+            'pages': paginator.num_pages,
+            'biffs': biffs,
+        }, sort_keys=True), 'application/json')
 
     def _validate_add(self, req, biff_config):
-        biff_values = biff_config.biff.values()
-        return self._validate_common(req, biff_values)
+        return self._validate_common(req, biff_config)
 
     def _validate_update(self, req, biff_key, biff_config):
-        func = lambda x: x['key'] != biff_key
-        biff_values = filter(func, biff_config.biff.values())
-        return self._validate_common(req, biff_values)
+        return self._validate_common(req, biff_config, biff_key)
 
-    def _validate_common(self, req, biff_values):
+    def _validate_common(self, req, biff_config, biff_key=None):
         name = req.args.get('name')
         cc = req.args.get('cc')
         filename = req.args.get('filename')
@@ -93,38 +191,74 @@ class ChangefileBiffAdminPage(Component):
             return False
 
         if cc:
-            all_users = [_u for _u, __, __ in self.env.get_known_users()]
-            cc_users = [_u.strip() for _u in cc.split(',')]
-            for user in cc_users:
-                if user not in all_users:
+            for user in split_values(cc):
+                if not self._is_known_user(user):
                     _msg = _("The user '%(user)s' is not existed.", user=user)
                     add_warning(req, _msg)
                     return False
 
-        biff_names = map(lambda x: x['name'], biff_values)
-        if name in biff_names:
-            add_warning(req, _('The name is already used.'))
-            return False
+        repository = req.args.get('repository')
+        if repository:
+            all_repos = [_r or DEFAULT_REPOSITORY for _r in
+                         RepositoryManager(self.env).get_all_repositories()]
+            for reponame in split_values(repository):
+                if reponame not in all_repos:
+                    _msg = _("The repository '%(repo)s' is not existed.",
+                             repo=reponame)
+                    add_warning(req, _msg)
+                    return False
 
-        multiple_fields = ['filename']
-        for field_name in multiple_fields:
-            if not self._validate_multiple_field(req, field_name, biff_values):
-                return False
+        mp = biff_config.ticket_custom_config.get_matching_pattern_value()
+        if mp == 'regex':
+            for pattern in split_values(filename):
+                error = RegexMatcher.validate(pattern)
+                if error is not None:
+                    _msg = _("The regular expression '%(pattern)s' is "
+                             "invalid: %(error)s", pattern=pattern,
+                             error=error)
+                    add_warning(req, _msg)
+                    return False
 
-        return True
+        snapshot = biff_config.snapshot
+        if snapshot.names.get(name, biff_key) != biff_key:
+            add_warning(req, _('The name is already used.'))
+            return False
 
-    def _validate_multiple_field(self, req, field_name, biff_values):
-        _values = map(lambda x: x[field_name], biff_values)
-        biff_fvalues = [__f.strip() for _f in _values for __f in _f.split(',')]
-        fvalues = [_f.strip() for _f in req.args.get(field_name).split(',')]
-        for fvalue in fvalues:
-            if fvalue in biff_fvalues:
+        patterns = split_values(filename)
+        for pattern in patterns:
+            if snapshot.patterns.get(pattern, set()) - set([biff_key]):
                 _msg = _("The value '%(fvalue)s' is already configured.",
-                         fvalue=fvalue)
+                         fvalue=pattern)
                 add_warning(req, _msg)
                 return False
+
+        # overlapping patterns are allowed, but they may be unintended
+        for pattern, key, other in snapshot.find_overlaps(self.env, patterns,
+                                                          biff_key):
+            other_name = snapshot.biff[key]['name']
+            if other is None:
+                _msg = _("Some files of '%(pattern)s' are also matched by "
+                         "File Biff '%(name)s'.", pattern=pattern,
+                         name=other_name)
+            else:
+                _msg = _("'%(pattern)s' also matches the files of "
+                         "'%(other)s' in File Biff '%(name)s'.",
+                         pattern=pattern, other=other, name=other_name)
+            add_warning(req, _msg)
+
         return True
 
+    def _is_known_user(self, user):
+        now = time.time()
+        loaded = self._known_users
+        if loaded is None or now - loaded[0] > self.known_users_ttl or \
+                user not in loaded[1]:
+            # reload for the user added after the cache is loaded
+            loaded = (now, frozenset(_u for _u, __, __
+                                     in self.env.get_known_users()))
+            self._known_users = loaded
+        return user in loaded[1]
+
     def _add_notice_saved(self, req):
         _msg = 'messages'
         add_notice(req, (dgettext)(_msg, 'Your changes have been saved.'))
@@ -138,3 +272,205 @@ class ChangefileBiffAdminPage(Component):
 
     def get_htdocs_dirs(self):
         return [('changefilebiff', resource_filename(__name__, 'htdocs'))]
+
+
+class ChangefileBiffAdminCommand(Component):
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('filebiff drain', '[limit]',
+               'Process the changesets queued by asynchronous mode',
+               None, self._do_drain)
+        yield ('filebiff flush', '',
+               'Write the ticket changes merged by `coalesce_window` now',
+               None, self._do_flush)
+        yield ('filebiff queue', '',
+               'Show the number of queued changesets and the oldest one',
+               None, self._do_queue)
+        yield ('filebiff queue reset', '',
+               'Retry the changesets which failed too many times',
+               None, self._do_queue_reset)
+        yield ('filebiff rename', '<name> <newname>',
+               """Rename a File Biff setting and the value of the tickets
+
+               The tickets are updated in chunks of `bulk_batch_size`
+               tickets. Run it again with the same arguments to resume
+               when it is interrupted.""",
+               self._complete_name, self._do_rename)
+        yield ('filebiff remove', '<name>',
+               """Remove a File Biff setting and the value of the tickets
+
+               Run it again with the same argument to resume when it is
+               interrupted.""",
+               self._complete_name, self._do_remove)
+
+        yield ('filebiff resync', '<repos> [rev[:rev]]',
+               """Apply File Biff settings to the past changesets
+
+               Without the revision range, it resumes from the revision
+               next to the last one processed by the previous run, up to
+               the end of its range if it was interrupted. Use
+               "(default)" for the default repository.""",
+               self._complete_repos, self._do_resync)
+
+        yield ('filebiff hits', '[days]',
+               """Show the number of changesets matched by each File Biff
+
+               Without days, it shows the numbers of all time. The
+               settings which never changed tickets come first.""",
+               None, self._do_hits)
+
+        yield ('filebiff match', '[repos]',
+               """Show File Biff settings which would be applied to paths
+
+               The paths are read from the standard input separated by
+               newline, e.g. the output of `git diff --name-only`. Use
+               "(default)" for the default repository.""",
+               self._complete_repos, self._do_match)
+
+        yield ('filebiff stats', '',
+               'Show the statistics of File Biff processing',
+               None, self._do_stats)
+        yield ('filebiff stats reset', '',
+               'Clear the statistics of File Biff processing',
+               None, self._do_stats_reset)
+
+    def _complete_repos(self, args):
+        if len(args) == 1:
+            rm = RepositoryManager(self.env)
+            return [reponame or DEFAULT_REPOSITORY
+                    for reponame in rm.get_all_repositories()]
+
+    def _complete_name(self, args):
+        if len(args) == 1:
+            biff_config = ChangefileBiffConfig(self.env, self.config)
+            return [biff['name'] for biff in biff_config.biff.values()]
+
+    def _print_progress(self, done, total):
+        printout(_('%(done)d/%(total)d tickets updated',
+                   done=done, total=total))
+
+    def _do_rename(self, name, newname):
+        biff_config = ChangefileBiffConfig(self.env, self.config)
+        key = biff_config.get_key_by_name(name)
+        if key:
+            if biff_config.get_key_by_name(newname):
+                raise TracError(_('The name is already used.'))
+            values = dict(biff_config.biff[key], name=newname)
+            biff_config.update(getuser(), values, key, self._print_progress)
+        elif biff_config.get_key_by_name(newname):
+            # resume the interrupted rename of the tickets
+            biff_config.ticket_custom_config.update_ticket_field(
+                getuser(), name, newname, self._print_progress)
+        else:
+            raise TracError(_("File Biff '%(name)s' does not exist.",
+                              name=name))
+
+    def _do_remove(self, name):
+        biff_config = ChangefileBiffConfig(self.env, self.config)
+        key = biff_config.get_key_by_name(name)
+        if key:
+            biff_config.remove(getuser(), [key], self._print_progress)
+        else:
+            # resume the interrupted removal of the tickets
+            biff_config.ticket_custom_config.remove_ticket_field(
+                getuser(), [name], self._print_progress)
+
+    def _do_drain(self, limit=None):
+        listener = ChangefileBiffRepositoryChangeListener(self.env)
+        latencies, failures = listener.drain(int(limit) if limit else None)
+        printout(_('%(count)d changesets processed, %(failures)d failed.',
+                   count=len(latencies), failures=failures))
+        if latencies:
+            printout(_('Latency: average %(avg).1fs, maximum %(max).1fs',
+                       avg=sum(latencies) / len(latencies),
+                       max=max(latencies)))
+
+    def _do_flush(self):
+        listener = ChangefileBiffRepositoryChangeListener(self.env)
+        count = listener.flush_pending(force=True)
+        printout(_('%(count)d tickets updated.', count=count))
+
+    def _do_queue(self):
+        listener = ChangefileBiffRepositoryChangeListener(self.env)
+        status = ChangesetQueue(self.env).status(listener.queue_max_attempts)
+        printout(_('Pending: %(pending)d, Failed: %(failed)d',
+                   pending=status['pending'], failed=status['failed']))
+        if status['oldest']:
+            age = pretty_timedelta(from_utimestamp(status['oldest']))
+            printout(_('Oldest pending changeset was queued %(age)s ago',
+                       age=age))
+
+    def _do_queue_reset(self):
+        listener = ChangefileBiffRepositoryChangeListener(self.env)
+        ChangesetQueue(self.env).reset_failed(listener.queue_max_attempts)
+
+    def _do_resync(self, reponame, rev_range=None):
+        if reponame == DEFAULT_REPOSITORY:
+            reponame = ''
+        repos = RepositoryManager(self.env).get_repository(reponame)
+        if repos is None:
+            raise TracError(_("Repository '%(repo)s' not found",
+                              repo=reponame or DEFAULT_REPOSITORY))
+
+        start = stop = None
+        if rev_range:
+            start, sep, stop = rev_range.partition(':')
+            start = start or repos.oldest_rev
+            stop = stop or (None if sep else start)
+
+        def progress(count, rev):
+            printout(_('%(count)d changesets processed, last revision is '
+                       '%(rev)s', count=count, rev=rev))
+
+        listener = ChangefileBiffRepositoryChangeListener(self.env)
+        listener.resync(repos, start, stop, progress)
+
+    def _do_hits(self, days=None):
+        biff_config = ChangefileBiffConfig(self.env, self.config)
+        hits = BiffHits(self.env).get_totals(int(days) if days else None)
+        rows = []
+        for key, biff in biff_config.biff.iteritems():
+            count, last_hit = hits.get(key, (0, None))
+            rows.append((count, biff['name'],
+                         pretty_timedelta(last_hit) if last_hit else '-'))
+        print_table(sorted(rows, key=lambda row: (row[0], row[1])),
+                    [_('Hits'), _('Name'), _('Last hit ago')])
+
+    def _do_match(self, reponame=None):
+        if reponame == DEFAULT_REPOSITORY:
+            reponame = ''
+        paths = (line.strip().decode(sys.stdin.encoding or 'utf-8')
+                 for line in sys.stdin)
+        listener = ChangefileBiffRepositoryChangeListener(self.env)
+        biffs = listener.match_paths(reponame or '',
+                                     (path for path in paths if path))
+        print_table([(name, ', '.join(cc)) for name, cc in biffs],
+                    [_('Name'), _('Cc')])
+        printout(_('Cc: %(cc)s', cc=', '.join(sorted(set(
+            user for __, cc in biffs for user in cc)))))
+
+    def _do_stats(self):
+        stats = ChangefileBiffStats(self.env)
+        if not stats.enabled:
+            printout(_('Statistics are disabled, enable [changefilebiff] '
+                       'stats option to record them.'))
+        print_table(stats.get_counters(), [_('Counter'), _('Value')])
+        print_table([(phase, count, '%.1f' % (average * 1000),
+                      _format_bound(p50), _format_bound(p95))
+                     for phase, count, average, p50, p95
+                     in stats.get_latencies()],
+                    [_('Phase'), _('Count'), _('Average (ms)'),
+                     _('50% (ms)'), _('95% (ms)')])
+
+    def _do_stats_reset(self):
+        ChangefileBiffStats(self.env).reset()
+
+
+def _format_bound(bound):
+    """Format the upper bound of a latency bucket in milliseconds."""
+    if bound is None:
+        return '> %g' % (LATENCY_BUCKETS[-2] * 1000)
+    return '<= %g' % (bound * 1000)
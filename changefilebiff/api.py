@@ -1,102 +1,637 @@
 # -*- coding: utf-8 -*-
+import multiprocessing
 from datetime import datetime
 
-from trac.core import Component, implements
+from trac.config import BoolOption, IntOption, Option
+from trac.core import Component, TracError, implements
+from trac.db.api import DatabaseManager
 from trac.env import IEnvironmentSetupParticipant
 from trac.perm import PermissionCache
-from trac.ticket import Ticket
-from trac.util.datefmt import utc
+from trac.ticket.api import ITicketChangeListener
+from trac.ticket.model import Ticket
+from trac.util.datefmt import to_utimestamp, utc
 from trac.util.text import exception_to_unicode
 from trac.util.translation import domain_functions
 from trac.versioncontrol.api import IRepositoryChangeListener
+from trac.versioncontrol.api import RepositoryManager
 from tracopt.ticket.commit_updater import CommitTicketUpdater
 
+import db_default
+from matcher import DEFAULT_PATH_CACHE_SIZE, get_path_cache
+from stats import ChangefileBiffStats
+from util import LRUCache
+
 
 add_domain, _, N_, gettext, ngettext, tag_ = domain_functions(
     'changefilebiff', ('add_domain', '_', 'N_', 'gettext', 'ngettext', 'tag_'))
 
 
-from model import ChangefileBiffConfig
-from model import FileBiffTicketCustomField
+from model import (BiffHits, ChangefileBiffConfig, ChangesetQueue,
+                   DbBiffStore, FileBiffTicketCustomField,
+                   FileBiffTicketIndex, PendingTicketUpdates,
+                   ResyncCheckpoint, TicketCustomFileBiffConfig,
+                   DEFAULT_BULK_BATCH_SIZE, DEFAULT_TICKET_BATCH_SIZE,
+                   split_values, update_tickets)
 
 
-__all__ = ['ChangefileBiffModule', 'ChangefileBiffRepositoryChangeListener']
+__all__ = ['ChangefileBiffModule', 'ChangefileBiffRepositoryChangeListener',
+           'ChangefileBiffTicketChangeListener']
 
 
 class ChangefileBiffModule(Component):
 
     implements(IEnvironmentSetupParticipant)
 
+    storage = Option(
+        'changefilebiff', 'storage', 'db',
+        """Store of File Biff settings, `db` for `filebiff` table or `ini`
+        for this section. The settings in this section are moved into the
+        table when the environment is upgraded with `db`.""")
+
+    bulk_batch_size = IntOption(
+        'changefilebiff', 'bulk_batch_size', DEFAULT_BULK_BATCH_SIZE,
+        """Number of tickets changed in a transaction when a File Biff
+        setting is renamed or removed.""")
+
+    path_cache_size = IntOption(
+        'changefilebiff', 'path_cache_size', DEFAULT_PATH_CACHE_SIZE,
+        """Number of paths whose matched File Biff settings are memoized
+        in each process, 0 disables it.""")
+
     def __init__(self):
         from pkg_resources import resource_exists, resource_filename
         if resource_exists(__name__, 'locale'):
             add_domain(self.env.path, resource_filename(__name__, 'locale'))
 
+    # IEnvironmentSetupParticipant methods
     def environment_created(self):
-        pass
+        self.upgrade_environment(None)
 
     def environment_needs_upgrade(self, db):
-        return False
+        ticket_custom_config = TicketCustomFileBiffConfig(self.env,
+                                                          self.config)
+        if not ticket_custom_config.has_custom_field():
+            return True
+        return self._get_schema_version() < db_default.version
 
     def upgrade_environment(self, db):
-        pass
+        # trac.ini is written only here, the runtime is read-only for it
+        ticket_custom_config = TicketCustomFileBiffConfig(self.env,
+                                                          self.config)
+        if not ticket_custom_config.has_custom_field():
+            ticket_custom_config.add_custom_field()
+
+        current_version = self._get_schema_version()
+        if current_version >= db_default.version:
+            return
+
+        connector = DatabaseManager(self.env).get_connector()[0]
+        with self.env.db_transaction as db:
+            for version in range(current_version + 1, db_default.version + 1):
+                for table in db_default.tables.get(version, []):
+                    for stmt in connector.to_sql(table):
+                        db(stmt)
+                upgrade = getattr(self, '_upgrade_to_%d' % version, None)
+                if upgrade:
+                    upgrade(db)
+            if current_version < 1:
+                # the settings are read with all columns of the latest schema
+                self._migrate_ini_to_db()
+            self._set_schema_version(db, current_version)
+
+    def _get_schema_version(self):
+        for value, in self.env.db_query("""
+                SELECT value FROM system WHERE name=%s
+                """, (self._schema_version_name,)):
+            return int(value)
+        return 0
+
+    def _set_schema_version(self, db, current_version):
+        if current_version:
+            db("UPDATE system SET value=%s WHERE name=%s",
+               (db_default.version, self._schema_version_name))
+        else:
+            db("INSERT INTO system (name, value) VALUES (%s, %s)",
+               (self._schema_version_name, db_default.version))
+        self.env.log.info('Upgraded %s schema from version %d to %d',
+                          db_default.name, current_version,
+                          db_default.version)
+
+    @property
+    def _schema_version_name(self):
+        return db_default.name + '_version'
+
+    def _upgrade_to_1(self, db):
+        db("INSERT INTO system (name, value) VALUES (%s, '')",
+           (DbBiffStore.GENERATION,))
+
+    def _migrate_ini_to_db(self):
+        biff_config = ChangefileBiffConfig(self.env, self.config)
+        if isinstance(biff_config.store, DbBiffStore):
+            count = biff_config.migrate_ini_to_db()
+            if count:
+                self.env.log.info('Moved %d File Biff settings from '
+                                  'trac.ini into the database', count)
+
+    def _upgrade_to_3(self, db):
+        count = FileBiffTicketIndex(self.env).rebuild()
+        self.env.log.info('Indexed %d File Biff values of tickets', count)
+
+    def _upgrade_to_5(self, db):
+        db("ALTER TABLE filebiff ADD COLUMN repository text")
+        db("UPDATE filebiff SET repository=''")
 
 
 class ChangefileBiffRepositoryChangeListener(Component):
 
     implements(IRepositoryChangeListener)
 
+    async_processing = BoolOption(
+        'changefilebiff', 'async', 'false',
+        """Enqueue the added changesets instead of processing them in the
+        repository hook. The queue is processed by `trac-admin $ENV
+        filebiff drain`.""")
+
+    queue_max_depth = IntOption(
+        'changefilebiff', 'queue_max_depth', 10000,
+        """Process the changesets synchronously while the queue has this
+        number of changesets or more.""")
+
+    queue_max_attempts = IntOption(
+        'changefilebiff', 'queue_max_attempts', 5,
+        """Maximum number of attempts to process a queued changeset.""")
+
+    queue_retry_delay = IntOption(
+        'changefilebiff', 'queue_retry_delay', 60,
+        """Seconds to wait before retrying a failed changeset, it is
+        doubled at every attempt.""")
+
+    resync_processes = IntOption(
+        'changefilebiff', 'resync_processes', 0,
+        """Number of processes matching the changesets in `trac-admin $ENV
+        filebiff resync`, the number of CPUs is used if 0.""")
+
+    resync_window = IntOption(
+        'changefilebiff', 'resync_window', 1000,
+        """Number of changesets matched at once in `trac-admin $ENV
+        filebiff resync`, the progress is saved after each of them.""")
+
+    ticket_batch_size = IntOption(
+        'changefilebiff', 'ticket_batch_size', DEFAULT_TICKET_BATCH_SIZE,
+        """Number of tickets updated in a transaction.""")
+
+    coalesce_window = IntOption(
+        'changefilebiff', 'coalesce_window', 0,
+        """Seconds to merge the File Biff values and cc of a ticket across
+        changesets, e.g. the ones in a push, before writing them as one
+        ticket change. The pending tickets are written by the following
+        changesets, `trac-admin $ENV filebiff drain` or `filebiff flush`.
+        0 disables it.""")
+
+    coalesce_batch_size = IntOption(
+        'changefilebiff', 'coalesce_batch_size', 100,
+        """Write all pending tickets regardless of `coalesce_window` when
+        this number of tickets is pending.""")
+
+    # permissions checked by the commands of CommitTicketUpdater
+    COMMAND_PERMISSIONS = {
+        'cmd_close': 'TICKET_MODIFY',
+        'cmd_refs': 'TICKET_APPEND',
+    }
+
+    def __init__(self):
+        self._ticket_refs_cache = LRUCache(256)
+        self._matched_keys_cache = LRUCache(256)
+        self.stats = ChangefileBiffStats(self.env)
+
+    # IRepositoryChangeListener methods
     def changeset_added(self, repos, changeset):
-        biff_names, biff_cc = self._get_biff_names_and_cc(changeset)
-        if biff_names:
-            self._update_ticket(changeset, biff_names, biff_cc)
+        with self.stats.recorder.timer('changeset_added'):
+            if not (self.async_processing and
+                    self._enqueue(repos, changeset)):
+                self.process_changeset(repos, changeset)
+            self.flush_pending()
+        self.stats.flush('changeset_added')
 
     def changeset_modified(self, repos, changeset, old_changeset):
-        pass
+        """Apply the biffs to the tickets newly referenced by the message.
+
+        A modification changes only the metadata, so the files are matched
+        only when a ticket is newly referenced. The result is reused if
+        this process has matched the changeset, otherwise get_changes() is
+        walked again, e.g. in `trac-admin $ENV changeset modified` hook.
+        old_changeset is None if the repository is not cached, then all
+        tickets are new. Nothing is removed from the tickets no longer
+        referenced.
+        """
+        with self.stats.recorder.timer('changeset_modified'):
+            self._process_modified(repos, changeset, old_changeset)
+            self.flush_pending()
+        self.stats.flush('changeset_modified')
+
+    def _process_modified(self, repos, changeset, old_changeset):
+        ticket_updator = self._get_ticket_updator()
+        if not ticket_updator:
+            return
+
+        new_refs = self._get_ticket_refs(repos, changeset, ticket_updator)
+        old_refs = {}
+        if old_changeset is not None:
+            old_refs = self._get_ticket_refs(repos, old_changeset,
+                                             ticket_updator)
+        added_tickets = set(new_refs) - set(old_refs)
+        if not added_tickets:
+            return
+
+        biff_names, biff_cc = self._get_biff_names_and_cc(repos, changeset)
+        if biff_names:
+            self._update_ticket(repos, changeset, biff_names, biff_cc,
+                                added_tickets)
+
+    def resync(self, repos, start=None, stop=None, progress=None):
+        """Process the past changesets from start to stop revision.
+
+        The changed files are matched in a pool of processes and the
+        tickets are updated only by this process. When start is None, it
+        resumes from the revision next to the checkpoint saved after each
+        window of changesets, to the stop revision of the interrupted run.
+        """
+        # never advance the checkpoint without updating the tickets
+        self._require_ticket_updator()
+        checkpoint = ResyncCheckpoint(self.env, repos.reponame)
+        if start is None:
+            last_rev, last_stop = checkpoint.get()
+            if last_rev is not None:
+                start = repos.next_rev(repos.normalize_rev(last_rev))
+                if start is None:
+                    return 0
+                if stop is None:
+                    stop = last_stop
+            else:
+                start = repos.oldest_rev
+        rev = repos.normalize_rev(start)
+        stop = repos.normalize_rev(stop if stop is not None
+                                   else repos.youngest_rev)
+
+        snapshot = ChangefileBiffConfig(self.env, self.config).snapshot
+        # the paths of past changesets are rarely matched again
+        biff_index = snapshot.get_index(self.env, repos.reponame,
+                                        cached=False)
+        processes = self.resync_processes or multiprocessing.cpu_count()
+        pool = None
+        if processes > 1:
+            pool = multiprocessing.Pool(processes, _resync_init, (biff_index,))
+
+        window_size = max(1, self.resync_window)
+        count = 0
+        try:
+            while rev is not None:
+                window = []
+                while rev is not None and len(window) < window_size:
+                    changeset = repos.get_changeset(rev)
+                    window.append((rev, [chg[0] for chg in
+                                         changeset.get_changes()]))
+                    if repos.rev_older_than(rev, stop):
+                        rev = repos.next_rev(rev)
+                    else:
+                        rev = None
+                if pool:
+                    results = pool.map(_resync_match, window)
+                else:
+                    results = [(rev_, biff_index.match_files(paths))
+                               for rev_, paths in window]
+
+                for rev_, matched_keys in results:
+                    if matched_keys:
+                        changeset = repos.get_changeset(rev_)
+                        BiffHits(self.env).record(matched_keys,
+                                                  repos.reponame,
+                                                  unicode(rev_),
+                                                  changeset.date)
+                        biff_names, biff_cc = \
+                            self._get_names_and_cc(snapshot, matched_keys)
+                        self._update_ticket(repos, changeset, biff_names,
+                                            biff_cc)
+                count += len(window)
+                # the stop is kept until the range is done
+                checkpoint.set(unicode(window[-1][0]),
+                               unicode(stop) if rev is not None else None)
+                self.flush_pending(force=True)
+                self.stats.flush('resync')
+                if progress:
+                    progress(count, window[-1][0])
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return count
+
+    def process_changeset(self, repos, changeset):
+        self.stats.recorder.incr('changesets')
+        snapshot = ChangefileBiffConfig(self.env, self.config).snapshot
+        matched_keys = self._get_matched_keys(repos, changeset, snapshot)
+        if matched_keys:
+            # counted whether or not the message refers to any ticket
+            BiffHits(self.env).record(matched_keys, repos.reponame,
+                                      unicode(changeset.rev), changeset.date)
+            biff_names, biff_cc = self._get_names_and_cc(snapshot,
+                                                         matched_keys)
+            self._update_ticket(repos, changeset, biff_names, biff_cc)
+
+    def _enqueue(self, repos, changeset):
+        queue = ChangesetQueue(self.env)
+        if queue.depth(self.queue_max_attempts) >= self.queue_max_depth:
+            self.env.log.warn('File Biff queue is full, processing changeset '
+                              '%s in %s synchronously', changeset.rev,
+                              repos.reponame or '(default)')
+            return False
+        queue.enqueue(repos.reponame, unicode(changeset.rev))
+        return True
+
+    def drain(self, limit=None):
+        """Process the queued changesets, returns a list of the latency
+        in seconds of the processed changesets and the number of failures.
+        """
+        # the changesets are kept in the queue until it is enabled
+        self._require_ticket_updator()
+        queue = ChangesetQueue(self.env)
+        rm = RepositoryManager(self.env)
+        lease = self.queue_retry_delay * 1000000
+        latencies, failures = [], 0
+        for id_, reponame, rev, time, attempts in \
+                queue.claim(self.queue_max_attempts, lease, limit):
+            try:
+                repos = rm.get_repository(reponame)
+                if repos is None:
+                    raise ValueError('Repository "%s" not found' % reponame)
+                changeset = repos.get_changeset(repos.normalize_rev(rev))
+                self.process_changeset(repos, changeset)
+            except Exception as e:
+                failures += 1
+                attempts += 1
+                error = exception_to_unicode(e)
+                self.env.log.error('Failed to process changeset %s in %s '
+                                   '(attempt %d): %s', rev,
+                                   reponame or '(default)', attempts, error)
+                queue.retry(id_, attempts, lease * 2 ** (attempts - 1), error)
+            else:
+                queue.done(id_)
+                now = to_utimestamp(datetime.now(utc))
+                latencies.append((now - time) / 1000000.0)
+            self.stats.flush('drain')
+        self.flush_pending()
+        self.stats.flush('drain')
+        return latencies, failures
 
-    def _get_biff_names_and_cc(self, changeset):
+    def flush_pending(self, force=False):
+        """Write the pending tickets merged by `coalesce_window`.
+
+        Only the tickets first changed `coalesce_window` seconds ago or
+        before are written unless force is True or `coalesce_batch_size`
+        tickets are pending. Returns the number of written tickets.
+        """
+        if not force and self.coalesce_window <= 0:
+            return 0
+        pending = PendingTicketUpdates(self.env)
+        before = None
+        if not force and pending.count() < self.coalesce_batch_size:
+            before = to_utimestamp(datetime.now(utc)) - \
+                     self.coalesce_window * 1000000
+        due = pending.get_due(before)
+        if not due:
+            return 0
+        # e.g. `refs #99999`, it is never written
+        pending.discard_missing()
+
+        def update(ticket):
+            # merged values are removed in the transaction of the ticket
+            item = pending.pop(ticket.id)
+            if item is None:
+                return False
+            biff_names, cc_users = item
+            if cc_users:
+                ticket['cc'] += ', ' + ', '.join(cc_users)
+            fb_field = FileBiffTicketCustomField(ticket)
+            fb_field.add(biff_names)
+            return fb_field.is_updated
+
+        tkt_ids_by_author = {}
+        for tkt_id, author in due:
+            tkt_ids_by_author.setdefault(author, []).append(tkt_id)
+        with self.stats.recorder.timer('update_ticket'):
+            for author, tkt_ids in sorted(tkt_ids_by_author.iteritems()):
+                update_tickets(self.env, tkt_ids, update, author, '',
+                               datetime.now(utc), self.ticket_batch_size)
+        return len(due)
+
+    def match_paths(self, reponame, paths):
+        """Return a list of (name, cc users) of biffs which would be
+        applied to a changeset of paths in the repository. paths is
+        consumed lazily, so it can be a stream of many paths.
+        """
+        snapshot = ChangefileBiffConfig(self.env, self.config).snapshot
+        recorder = self.stats.recorder
+        with recorder.timer('match'):
+            # arbitrary paths must not evict the ones of the commits
+            biff_index = snapshot.get_index(self.env, reponame, cached=False)
+            matched_keys = biff_index.match_files(
+                recorder.count_iter('files_scanned', paths))
+        self.stats.flush('match')
+        return sorted((snapshot.biff[key]['name'],
+                       split_values(snapshot.biff[key]['cc'] or ''))
+                      for key in matched_keys)
+
+    def _get_biff_names_and_cc(self, repos, changeset):
+        snapshot = ChangefileBiffConfig(self.env, self.config).snapshot
+        matched_keys = self._get_matched_keys(repos, changeset, snapshot)
+        return self._get_names_and_cc(snapshot, matched_keys)
+
+    def _get_matched_keys(self, repos, changeset, snapshot):
+        """Return the keys of biffs matching to the changeset, the result
+        is cached per revision while the settings are not changed.
+        """
+        key = (repos.reponame, changeset.rev)
+        cached = self._matched_keys_cache.get(key)
+        if cached and cached[0] == snapshot.version:
+            return cached[1]
+
+        recorder = self.stats.recorder
+        path_cache = get_path_cache(self.env.path)
+        hits, misses = path_cache.hits, path_cache.misses
+        with recorder.timer('match'):
+            biff_index = snapshot.get_index(self.env, repos.reponame)
+            # get_changes() is walked only once and never kept as a list,
+            # chg is (path, kind, change, base_path, base_rev)
+            paths = (chg[0] for chg in changeset.get_changes())
+            matched_keys = frozenset(biff_index.match_files(
+                recorder.count_iter('files_scanned', paths)))
+        recorder.incr('biffs_matched', len(matched_keys))
+        recorder.incr('path_cache_hits', path_cache.hits - hits)
+        recorder.incr('path_cache_misses', path_cache.misses - misses)
+        self._matched_keys_cache[key] = (snapshot.version, matched_keys)
+        return matched_keys
+
+    def _get_names_and_cc(self, snapshot, biff_keys):
         biff_names, biff_cc = set(), set()
-        biff_config = ChangefileBiffConfig(self.env, self.config)
-        biff_matcher = biff_config.get_filename_matcher()
-
-        for biff in biff_config.biff.values():
-            biff_filenames = [_f.strip() for _f in biff['filename'].split(',')]
-            match_files = biff_matcher.match_files(
-                biff_filenames,
-                # chg is (path, kind, change, base_path, base_rev)
-                [chg[0] for chg in changeset.get_changes()])
-
-            if any(match_files):
-                biff_names.add(biff['name'])
-                biff_cc.add(biff['cc'])
+        for key in biff_keys:
+            biff_names.add(snapshot.biff[key]['name'])
+            biff_cc.add(snapshot.biff[key]['cc'])
         return biff_names, biff_cc
 
-    def _update_ticket(self, changeset, biff_names, biff_cc):
-        ticket_updator = self.env.compmgr.components.get(CommitTicketUpdater)
-        if not ticket_updator:
+    def _get_ticket_refs(self, repos, changeset, ticket_updator):
+        """Return a dict of the ticket ids referenced by the changeset
+        message. The value is True when the author has permission for any
+        of the commands, or the commands which should be evaluated against
+        the ticket to know it.
+
+        The result is cached per changeset, so the message is parsed once
+        even if the changeset is processed again.
+        """
+        key = (repos.reponame, changeset.rev, changeset.author,
+               changeset.message)
+        refs = self._ticket_refs_cache.get(key)
+        if refs is not None:
+            return refs
+
+        refs = {}
+        with self.stats.recorder.timer('parse_message'):
+            tickets = ticket_updator._parse_message(changeset.message)
+        perm = PermissionCache(self.env, changeset.author)
+        for tkt_id, cmds in tickets.iteritems():
+            ticket_perm = perm('ticket', tkt_id)
+            other_cmds = []
+            for cmd in cmds:
+                action = self.COMMAND_PERMISSIONS.get(
+                    getattr(cmd, '__name__', None))
+                if action is None:
+                    other_cmds.append(cmd)
+                elif not ticket_updator.check_perms or action in ticket_perm:
+                    refs[tkt_id] = True
+                    break
+            else:
+                if other_cmds:
+                    refs[tkt_id] = other_cmds
+        self._ticket_refs_cache[key] = refs
+        return refs
+
+    def _get_ticket_updator(self):
+        # components.get() returns only the instantiated one, and nothing
+        # instantiates it in trac-admin process
+        if not self.env.is_component_enabled(CommitTicketUpdater):
             self.env.log.error('CommitTicketUpdater is not available, '
                                'enable it to parse changeset message')
+            return None
+        return CommitTicketUpdater(self.env)
+
+    def _require_ticket_updator(self):
+        if self._get_ticket_updator() is None:
+            raise TracError(_('CommitTicketUpdater is not available, enable '
+                              'tracopt.ticket.commit_updater.* components.'))
+
+    def _update_ticket(self, repos, changeset, biff_names, biff_cc,
+                       tkt_ids=None):
+        ticket_updator = self._get_ticket_updator()
+        if not ticket_updator:
+            return
+
+        refs = self._get_ticket_refs(repos, changeset, ticket_updator)
+        if tkt_ids is not None:
+            refs = dict((tkt_id, cmds) for tkt_id, cmds in refs.iteritems()
+                        if tkt_id in tkt_ids)
+        if not refs:
             return
 
-        date = datetime.now(utc)
-        tickets = ticket_updator._parse_message(changeset.message)
         perm = PermissionCache(self.env, changeset.author)
-        for tkt_id, cmds in tickets.iteritems():
-            try:
-                has_permission = False
-                with self.env.db_transaction:
-                    ticket = Ticket(self.env, tkt_id)
-                    ticket_perm = perm(ticket.resource)
-                    for cmd in cmds:
-                        if cmd(ticket, changeset, ticket_perm) is not False:
-                            has_permission = True
-                    if has_permission:
-                        cc_list = ', ' + ', '.join(biff_cc)
-                        ticket['cc'] += cc_list
-                        fb_field = FileBiffTicketCustomField(ticket)
-                        fb_field.add(biff_names)
-                        if fb_field.is_updated:
-                            ticket.save_changes(changeset.author, '', date)
-            except Exception as e:
-                self.env.log.error('Unexpected error while processing ticket '
-                                   '#%s: %s', tkt_id, exception_to_unicode(e))
+
+        def is_permitted(ticket):
+            cmds = refs[ticket.id]
+            if cmds is True:
+                return True
+            ticket_perm = perm(ticket.resource)
+            return not all(cmd(ticket, changeset, ticket_perm) is False
+                           for cmd in cmds)
+
+        if self.coalesce_window > 0:
+            self._coalesce(refs, changeset, is_permitted, biff_names,
+                           biff_cc)
+            return
+
+        cc_list = ', ' + ', '.join(biff_cc)
+
+        def update(ticket):
+            if not is_permitted(ticket):
+                return False
+            ticket['cc'] += cc_list
+            fb_field = FileBiffTicketCustomField(ticket)
+            fb_field.add(biff_names)
+            return fb_field.is_updated
+
+        with self.stats.recorder.timer('update_ticket'):
+            update_tickets(self.env, sorted(refs), update, changeset.author,
+                           '', datetime.now(utc), self.ticket_batch_size)
+
+    def _coalesce(self, refs, changeset, is_permitted, biff_names, biff_cc):
+        tkt_ids = []
+        for tkt_id in sorted(refs):
+            if refs[tkt_id] is not True:
+                # the commands are evaluated against the current ticket
+                try:
+                    if not is_permitted(Ticket(self.env, tkt_id)):
+                        continue
+                except Exception as e:
+                    self.env.log.error('Failed to load ticket #%s: %s',
+                                       tkt_id, exception_to_unicode(e))
+                    continue
+            tkt_ids.append(tkt_id)
+        if tkt_ids:
+            PendingTicketUpdates(self.env).add(tkt_ids, changeset.author,
+                                               biff_names, biff_cc)
+            self.stats.recorder.incr('tickets_coalesced', len(tkt_ids))
+
+
+class ChangefileBiffTicketChangeListener(Component):
+    """Keep filebiff_ticket index in sync with the File Biff field."""
+
+    implements(ITicketChangeListener)
+
+    field_name = FileBiffTicketCustomField.field_name
+
+    # ITicketChangeListener methods
+    def ticket_created(self, ticket):
+        if ticket[self.field_name]:
+            self._sync(ticket)
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        if self.field_name in old_values:
+            self._sync(ticket)
+
+    def ticket_deleted(self, ticket):
+        FileBiffTicketIndex(self.env).delete(ticket.id)
+
+    # optional methods of ITicketChangeListener in Trac 1.0
+    def ticket_comment_modified(self, ticket, cdate, author, comment,
+                                old_comment):
+        pass  # the field values are not changed
+
+    def ticket_change_deleted(self, ticket, cdate, changes):
+        # the field values changed by the deleted change are reverted
+        if self.field_name in changes:
+            self._sync(Ticket(self.env, ticket.id))
+
+    def _sync(self, ticket):
+        fb_field = FileBiffTicketCustomField(ticket)
+        FileBiffTicketIndex(self.env).sync(ticket.id, fb_field.get_values())
+
+
+# the compiled index of biffs in a process of resync pool
+_resync_index = None
+
+
+def _resync_init(biff_index):
+    global _resync_index
+    _resync_index = biff_index
+
+
+def _resync_match(item):
+    rev, paths = item
+    return rev, _resync_index.match_files(paths)
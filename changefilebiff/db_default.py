@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from trac.db import Column, Index, Table
+
+name = 'changefilebiff'
+version = 7
+
+# upgrade steps: version -> tables created by the step, the other changes
+# are done by ChangefileBiffModule._upgrade_to_<version>
+tables = {
+    1: [
+        Table('filebiff', key='id')[
+            Column('id'),
+            Column('name'),
+            Column('cc'),
+            Column('filename'),
+            Index(['name'], unique=True),
+        ],
+    ],
+    2: [
+        Table('filebiff_queue', key='id')[
+            Column('id', auto_increment=True),
+            Column('repos'),
+            Column('rev'),
+            Column('time', type='int64'),
+            Column('next_time', type='int64'),
+            Column('attempts', type='int'),
+            Column('error'),
+            Index(['next_time']),
+        ],
+    ],
+    3: [
+        Table('filebiff_ticket', key=('name', 'ticket'))[
+            Column('name'),
+            Column('ticket', type='int'),
+            Index(['ticket']),
+        ],
+    ],
+    4: [
+        Table('filebiff_stats', key=('name', 'bucket'))[
+            Column('name'),
+            Column('bucket'),
+            Column('value', type='int64'),
+        ],
+    ],
+    6: [
+        Table('filebiff_pending', key='ticket')[
+            Column('ticket', type='int'),
+            Column('author'),
+            Column('biffs'),
+            Column('cc'),
+            Column('time', type='int64'),
+            Index(['time']),
+        ],
+    ],
+    7: [
+        # day is the number of days since the epoch, the rows of day 0
+        # and repos '' are the totals of each biff
+        Table('filebiff_hits', key=('biff', 'repos', 'day'))[
+            Column('biff'),
+            Column('repos'),
+            Column('day', type='int'),
+            Column('hits', type='int'),
+            Column('last_hit', type='int64'),
+        ],
+        # the biffs which have counted each changeset
+        Table('filebiff_hit_changeset', key=('repos', 'rev'))[
+            Column('repos'),
+            Column('rev'),
+            Column('biffs'),
+        ],
+    ],
+}
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import fnmatch
-from os.path import basename
+import re
+from os.path import basename, normcase
 from abc import ABCMeta, abstractmethod
+from threading import Lock
+
+from util import LRUCache
 
 try:
     from pathspec import PathSpec
@@ -12,11 +16,39 @@ except ImportError:
 
 DEFAULT_MATCHING_PATTERN = 'fnmatch'
 
+DEFAULT_PATH_CACHE_SIZE = 10000
+
+GLOB_CHARS = frozenset('*?[')
+
+# env.path -> LRUCache of (version of biffs, path) -> frozenset of matched
+# biff keys, the versions of environments may be same
+_path_caches = {}
+_path_caches_lock = Lock()
+
+
+def get_path_cache(env_path, maxsize=None):
+    """Return the path cache of the environment, maxsize is changed if
+    it is given.
+    """
+    with _path_caches_lock:
+        cache = _path_caches.get(env_path)
+        if cache is None:
+            cache = LRUCache(maxsize or DEFAULT_PATH_CACHE_SIZE)
+            _path_caches[env_path] = cache
+    if maxsize:
+        cache.maxsize = maxsize
+    return cache
+
+
 def get_filename_matcher(env, matching_pattern):
     """Get filename matcher for matching_pattern."""
 
     if matching_pattern in ['fnmatch', '', None]:
         return FnmatchMatcher()
+    elif matching_pattern == 'prefix':
+        return PrefixMatcher()
+    elif matching_pattern == 'regex':
+        return RegexMatcher()
     elif matching_pattern == 'gitignore':
         if have_pathspec:
             return GitIgnoreMatcher()
@@ -28,6 +60,78 @@ def get_filename_matcher(env, matching_pattern):
         return FnmatchMatcher()
 
 
+def clear_caches(env_path):
+    """Clear compiled patterns and matched paths cached by the matchers.
+
+    The compiled patterns are shared by the environments, but they are
+    cached by the patterns themselves.
+    """
+    GitIgnoreMatcher.clear_cache()
+    cache = _path_caches.get(env_path)
+    if cache is not None:
+        cache.clear()
+
+
+def has_glob(pattern):
+    return any(c in GLOB_CHARS for c in pattern)
+
+
+def translate_glob(pattern):
+    """Translate a glob pattern into a regular expression without any
+    trailing global flags, so that it can be embedded into another one.
+    """
+    regex = fnmatch.translate(pattern)
+    if regex.endswith('(?ms)'):  # Python 2.x puts the flags at the end
+        regex = regex[:-len('(?ms)')]
+    return regex
+
+
+class MultiRegex(object):
+    """Combine regular expressions of many biffs into a few compiled ones.
+
+    Each biff gets a named group wrapped by an optional lookahead, so one
+    scan of a string reports every biff whose expression matches. A plain
+    alternation of all expressions is used as a prefilter because most of
+    the strings match nothing.
+    """
+
+    # Python 2.x does not support more than 100 named groups in a pattern
+    GROUPS_PER_REGEX = 90
+
+    def __init__(self, biff_regexes, flags=re.S):
+        self.group_keys = {}
+        self.regexes = []
+        alternatives = []
+        chunk = []
+        for i, (key, regexes) in enumerate(biff_regexes):
+            group = 'b%d' % i
+            expr = '|'.join(regexes)
+            self.group_keys[group] = key
+            alternatives.append(expr)
+            chunk.append('(?:(?=(?P<%s>%s)))?' % (group, expr))
+            if len(chunk) == self.GROUPS_PER_REGEX:
+                self.regexes.append(re.compile(''.join(chunk), flags))
+                chunk = []
+        if chunk:
+            self.regexes.append(re.compile(''.join(chunk), flags))
+
+        self.prefilter = None
+        if alternatives:
+            self.prefilter = re.compile('(?:%s)' % '|'.join(alternatives),
+                                        flags)
+
+    def match(self, text):
+        """Return the set of biff keys whose expressions match text."""
+        if self.prefilter is None or not self.prefilter.match(text):
+            return set()
+
+        keys = set()
+        for regex in self.regexes:
+            for group, value in regex.match(text).groupdict().items():
+                if value is not None:
+                    keys.add(self.group_keys[group])
+        return keys
+
 
 class Matcher(object):
     __metaclass__ = ABCMeta
@@ -36,6 +140,81 @@ class Matcher(object):
     def match_files(self, filename_patterns, files):
         pass
 
+    def compile(self, biff_patterns):
+        """Compile an index from pairs of (biff key, filename patterns)."""
+        return MatcherIndex(self, biff_patterns)
+
+    def sample_path(self, pattern):
+        """Return a path matching to pattern to find overlapping patterns,
+        or None if it is unknown.
+        """
+        if '[' in pattern or pattern.startswith('!'):
+            return None
+        path = pattern.lstrip('/').replace('**/', '')
+        path = path.replace('*', 'x').replace('?', 'x')
+        if not path or path.endswith('/'):
+            path += 'x'
+        return path
+
+
+class MatcherIndex(object):
+    """Index to get the biff keys matching to changed files.
+
+    This generic one calls `Matcher.match_files` for each biff, the
+    matchers provide a compiled index for themselves if possible.
+    """
+
+    invalid = ()  # (biff key, pattern, error) ignored by the index
+
+    def __init__(self, matcher, biff_patterns):
+        self.matcher = matcher
+        self.biff_patterns = [(key, list(patterns))
+                              for key, patterns in biff_patterns]
+        self.keys = frozenset(key for key, __ in self.biff_patterns)
+
+    def match_path(self, path):
+        return set(key for key, patterns in self.biff_patterns
+                   if any(self.matcher.match_files(patterns, [path])))
+
+    def match_files(self, files):
+        """Return the biff keys matching to any of files.
+
+        files is consumed only once and lazily, so it can be a generator of
+        the changes. It stops as soon as all biffs are matched.
+        """
+        matched = set()
+        if not self.keys:
+            return matched
+
+        for path in files:
+            matched.update(self.match_path(path))
+            if len(matched) == len(self.keys):
+                break
+        return matched
+
+
+class CachedIndex(MatcherIndex):
+    """Index memoizing the matched biff keys for each path in the path
+    cache of an environment.
+
+    The same files are changed in commit after commit, the entries are
+    tagged with the version of biffs so that a stale one is never used.
+    """
+
+    def __init__(self, index, version, cache):
+        self.index = index
+        self.keys = index.keys
+        self.version = version
+        self.cache = cache
+
+    def match_path(self, path):
+        cache_key = (self.version, path.strip('/'))
+        matched = self.cache.get(cache_key)
+        if matched is None:
+            matched = frozenset(self.index.match_path(path))
+            self.cache[cache_key] = matched
+        return matched
+
 
 class FnmatchMatcher(Matcher):
     def match_files(self, filename_patterns, files):
@@ -44,8 +223,215 @@ class FnmatchMatcher(Matcher):
                 if fnmatch.fnmatch(basename(fname), pattern):
                     yield fname
 
+    def compile(self, biff_patterns):
+        return FnmatchIndex(biff_patterns)
+
+
+class FnmatchIndex(MatcherIndex):
+    """Compiled index of fnmatch patterns for all biffs.
+
+    Exact basenames and `*<suffix>` patterns are looked up in hash tables,
+    the remaining glob patterns are folded into `MultiRegex`.
+    """
+
+    def __init__(self, biff_patterns):
+        self.exact = {}  # basename -> biff keys
+        self.suffixes = {}  # length of suffix -> {suffix: biff keys}
+        self.any_keys = set()  # biff keys having '*'
+        globs = {}
+        keys = set()
+        for key, patterns in biff_patterns:
+            keys.add(key)
+            for pattern in patterns:
+                pattern = normcase(pattern)
+                if not has_glob(pattern):
+                    self.exact.setdefault(pattern, set()).add(key)
+                elif pattern == '*':
+                    self.any_keys.add(key)
+                elif pattern.startswith('*') and not has_glob(pattern[1:]):
+                    suffix = pattern[1:]
+                    self.suffixes.setdefault(len(suffix), {}) \
+                                 .setdefault(suffix, set()).add(key)
+                else:
+                    globs.setdefault(key, []).append(translate_glob(pattern))
+        self.keys = frozenset(keys)
+        self.globs = MultiRegex(globs.items())
+
+    def match_path(self, path):
+        name = normcase(basename(path))
+        matched = set(self.any_keys)
+        matched.update(self.exact.get(name, ()))
+        for length, suffixes in self.suffixes.items():
+            if len(name) >= length:
+                matched.update(suffixes.get(name[-length:], ()))
+        matched.update(self.globs.match(name))
+        return matched
+
 
 class GitIgnoreMatcher(Matcher):
+
+    _spec_cache = {}  # tuple of patterns -> PathSpec
+
+    @classmethod
+    def clear_cache(cls):
+        cls._spec_cache.clear()
+
+    def get_spec(self, filename_patterns):
+        """Return the compiled PathSpec cached by filename_patterns."""
+        patterns = tuple(filename_patterns)
+        spec = self._spec_cache.get(patterns)
+        if spec is None:
+            spec = PathSpec.from_lines('gitignore', patterns)
+            self._spec_cache[patterns] = spec
+        return spec
+
     def match_files(self, filename_patterns, files):
-        spec = PathSpec.from_lines('gitignore', filename_patterns)
+        spec = self.get_spec(filename_patterns)
         return spec.match_files(files)
+
+    def compile(self, biff_patterns):
+        return GitIgnoreIndex(self, biff_patterns)
+
+
+class GitIgnoreIndex(MatcherIndex):
+    """Index of the cached PathSpec for each biff."""
+
+    def __init__(self, matcher, biff_patterns):
+        super(GitIgnoreIndex, self).__init__(matcher, biff_patterns)
+        self.specs = [(key, matcher.get_spec(patterns))
+                      for key, patterns in self.biff_patterns]
+
+    def match_path(self, path):
+        return set(key for key, spec in self.specs
+                   if self._spec_matches(spec, path))
+
+    def match_files(self, files):
+        # only the specs of the biffs not matched yet are evaluated
+        matched = set()
+        pending = self.specs
+        for path in files:
+            if not pending:
+                break
+            hits = set(key for key, spec in pending
+                       if self._spec_matches(spec, path))
+            if hits:
+                matched.update(hits)
+                pending = [(key, spec) for key, spec in pending
+                           if key not in hits]
+        return matched
+
+    @staticmethod
+    def _spec_matches(spec, path):
+        # same as pathspec.util.match_file, the last matched pattern wins
+        matched = False
+        for pattern in spec.patterns:
+            if pattern.include is not None and pattern.regex.search(path):
+                matched = pattern.include
+        return matched
+
+
+class PrefixMatcher(Matcher):
+    """Match directories like `src/payments/` and the files under them."""
+
+    def match_files(self, filename_patterns, files):
+        index = PrefixIndex([(None, filename_patterns)])
+        for fname in files:
+            if index.match_path(fname):
+                yield fname
+
+    def compile(self, biff_patterns):
+        return PrefixIndex(biff_patterns)
+
+
+class PrefixIndex(MatcherIndex):
+    """Trie of path components built from the patterns of all biffs.
+
+    A pattern matches the path itself and the paths under it, so a
+    lookup costs the depth of the path regardless of the number of
+    patterns.
+    """
+
+    KEYS = None  # the entry of a trie node for the biff keys
+
+    def __init__(self, biff_patterns):
+        self.trie = {}
+        keys = set()
+        for key, patterns in biff_patterns:
+            keys.add(key)
+            for pattern in patterns:
+                node = self.trie
+                for component in self._split(pattern):
+                    node = node.setdefault(component, {})
+                node.setdefault(self.KEYS, set()).add(key)
+        self.keys = frozenset(keys)
+
+    def match_path(self, path):
+        # the keys on the root are of the patterns like `/`, all paths
+        node = self.trie
+        matched = set(node.get(self.KEYS, ()))
+        for component in self._split(path):
+            node = node.get(component)
+            if node is None:
+                break
+            matched.update(node.get(self.KEYS, ()))
+        return matched
+
+    @staticmethod
+    def _split(path):
+        return [c for c in path.split('/') if c]
+
+
+class RegexMatcher(Matcher):
+    """Match regular expressions searched in the path of the repository."""
+
+    def match_files(self, filename_patterns, files):
+        regexes = [re.compile(pattern) for pattern in filename_patterns]
+        for fname in files:
+            if any(regex.search(fname) for regex in regexes):
+                yield fname
+
+    def compile(self, biff_patterns):
+        return RegexIndex(biff_patterns)
+
+    def sample_path(self, pattern):
+        return None
+
+    @staticmethod
+    def validate(pattern):
+        """Return an error message if pattern cannot be combined with the
+        others, or None.
+        """
+        try:
+            regex = re.compile(pattern)
+        except re.error as e:
+            return str(e)
+        if regex.groups:
+            return 'capturing group is not allowed, use (?:...) instead'
+
+
+class RegexIndex(MatcherIndex):
+    """Regular expressions of each biff compiled into an alternation.
+
+    They are compiled once for the index, `RegexMatcher.match_files`
+    compiles them at every call and hundreds of them thrash the cache of
+    `re` module.
+    """
+
+    def __init__(self, biff_patterns):
+        self.invalid = []  # since they break the others of the biff
+        alternatives = {}
+        keys = set()
+        for key, patterns in biff_patterns:
+            keys.add(key)
+            for pattern in patterns:
+                error = RegexMatcher.validate(pattern)
+                if error is not None:
+                    self.invalid.append((key, pattern, error))
+                    continue
+                alternatives.setdefault(key, []).append('(?:%s)' % pattern)
+        self.keys = frozenset(keys)
+        self.regexes = [(key, re.compile('|'.join(exprs)).search)
+                        for key, exprs in alternatives.items()]
+
+    def match_path(self, path):
+        return set(key for key, search in self.regexes if search(path))
@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
+import os
 from datetime import datetime
-from itertools import chain
+from fnmatch import fnmatchcase
 from operator import methodcaller
+from threading import Lock
 
+from trac.resource import ResourceNotFound
 from trac.ticket import Ticket
-from trac.util import hex_entropy
-from trac.util.datefmt import utc
+from trac.util import hex_entropy, lazy
+from trac.util.datefmt import from_utimestamp, to_utimestamp, utc
 from trac.util.text import exception_to_unicode
 
 from api import _
+from stats import ChangefileBiffStats
 import matcher
 
 
@@ -22,35 +26,86 @@ class ChangefileBiffConfig(object):
         {'id': 'name', 'multiple': False, 'i18n': _('Name')},
         {'id': 'cc', 'multiple': True, 'i18n': _('Cc')},
         {'id': 'filename', 'multiple': True, 'i18n': _('Filename')},
+        {'id': 'repository', 'multiple': True, 'i18n': _('Repository')},
     ]
 
+    _snapshots = {}  # env.path -> BiffSnapshot
+    _generations = {}  # env.path -> number of changes in this process
+    _snapshot_lock = Lock()
+
     def __init__(self, env, config):
         self.env = env
         self.config = config
-        self.keys = self.config.getlist(self.SECTION, self.BIFF_KEYS, [])
         self.ticket_custom_config = TicketCustomFileBiffConfig(env, config)
-        if not self.ticket_custom_config.has_custom_field():
-            self.ticket_custom_config.add_custom_field()
+        self.store = self.get_store()
+        self.keys = list(self.snapshot.keys)
+
+    @property
+    def module(self):
+        """`ChangefileBiffModule` declaring the options of the settings."""
+        from api import ChangefileBiffModule
+        return ChangefileBiffModule(self.env)
+
+    def get_store(self, storage=None):
+        """Return the store of File Biff settings configured by
+        `[changefilebiff] storage` option (db or ini).
+        """
+        if storage is None:
+            storage = self.module.storage
+        if storage == 'ini':
+            return IniBiffStore(self.env, self.config)
+        elif storage != 'db':
+            self.env.log.warn('Unknown storage %s', storage)
+        return DbBiffStore(self.env)
+
+    @property
+    def version(self):
+        """Version of the settings, it changes when trac.ini is reloaded,
+        the store is changed or the settings are changed in this process.
+        """
+        mtime = getattr(self.config, '_lastmtime', None)
+        if mtime is None and self.config.filename:
+            try:
+                mtime = os.path.getmtime(self.config.filename)
+            except OSError:
+                mtime = None
+        return (mtime, self._generations.get(self.env.path, 0),
+                self.store.generation)
+
+    @property
+    def snapshot(self):
+        """Return the `BiffSnapshot` shared in this process, it is rebuilt
+        only when the version is changed.
+        """
+        version = self.version
+        snapshot = self._snapshots.get(self.env.path)
+        if snapshot is None or snapshot.version != version:
+            biff = self._load_biff()
+            mp = self.ticket_custom_config.get_matching_pattern_value()
+            snapshot = BiffSnapshot(version, [b['key'] for b in biff],
+                                    dict((b['key'], b) for b in biff), mp,
+                                    self.module.path_cache_size)
+            with self._snapshot_lock:
+                self._snapshots[self.env.path] = snapshot
+        return snapshot
 
     @property
     def biff(self):
-        def get_value(option, is_multiple):
-            if is_multiple:
-                rv = u', '.join(self.config.getlist(self.SECTION, option, []))
-            else:
-                rv = self.config.get(self.SECTION, option, '')
-            return rv
+        return dict(self.snapshot.biff)
 
-        biff = {}
-        for key in self.keys:
-            biff[key] = {'key': key}
+    def _load_biff(self):
+        biff = self.store.load()
+        for values in biff:
             for field in self.BIFF_FIELDS:
-                id_ = field['id']
-                option = self.BIFF_OPTION % (key, id_)
-                biff[key][id_] = get_value(option, field['multiple'])
-                biff[key][id_ + '_i18n'] = field['i18n']
+                values[field['id'] + '_i18n'] = field['i18n']
         return biff
 
+    def _changed(self):
+        with self._snapshot_lock:
+            generation = self._generations.get(self.env.path, 0)
+            self._generations[self.env.path] = generation + 1
+        matcher.clear_caches(self.env.path)
+
     @property
     def new_biff_key(self):
         return hex_entropy(16)
@@ -61,48 +116,146 @@ class ChangefileBiffConfig(object):
             catalog[field['id'] + '_i18n'] = field['i18n']
         return catalog
 
+    def normalize(self, opt_value):
+        """Return the values of BIFF_FIELDS from opt_value, the multiple
+        fields are joined by comma.
+        """
+        values = {}
+        for field in self.BIFF_FIELDS:
+            id_ = field['id']
+            value = opt_value.get(id_, u'')
+            if field['multiple']:
+                if not isinstance(value, (list, tuple)):
+                    value = value.split(',')
+                value = u', '.join(v.strip() for v in value if v.strip())
+            values[id_] = value
+        return values
+
     def add(self, opt_value):
         generated_key = self.new_biff_key
-        self.set_option(opt_value, generated_key, is_new=True)
+        old_options = self.ticket_custom_config.get_options_value()
+        self.store.insert(generated_key, self.normalize(opt_value))
+        self.keys.append(generated_key)
         self.ticket_custom_config.add_options_value(opt_value.get('name'))
-        self.config.save()
+        self._save(old_options)
         return generated_key
 
-    def update(self, authname, opt_value, key):
-        option = self.BIFF_OPTION % (key, 'name')
-        old_value = self.config.get(self.SECTION, option, '')
-        self.set_option(opt_value, key)
+    def update(self, authname, opt_value, key, progress=None):
+        old_value = self.store.get_name(key)
+        old_options = self.ticket_custom_config.get_options_value()
+        self.store.update(key, self.normalize(opt_value))
 
         new_value = opt_value.get('name')
         self.ticket_custom_config.update_options_value(authname,
-                                                       old_value, new_value)
-        self.config.save()
+                                                       old_value, new_value,
+                                                       progress)
+        self._save(old_options)
 
-    def remove(self, authname, keys):
+    def remove(self, authname, keys, progress=None):
         old_values = []
+        old_options = self.ticket_custom_config.get_options_value()
         for key in keys:
-            option = self.BIFF_OPTION % (key, 'name')
-            old_values.append(self.config.get(self.SECTION, option, ''))
-            self.remove_option(key)
+            old_values.append(self.store.get_name(key))
+            if key in self.keys:
+                self.keys.remove(key)
+        self.store.delete(keys)
+        BiffHits(self.env).delete(keys)
+
+        self.ticket_custom_config.remove_options_value(authname, old_values,
+                                                       progress)
+        self._save(old_options)
+
+    def _save(self, old_options):
+        # trac.ini is saved only when it has been changed since all the
+        # processes reload the environment when it is saved
+        if self.store.needs_config_save or \
+           old_options != self.ticket_custom_config.get_options_value():
+            self.config.save()
+        self._changed()
 
-        self.ticket_custom_config.remove_options_value(authname, old_values)
+    def save(self):
         self.config.save()
 
-    def set_option(self, opt_value, key, is_new=False):
-        if is_new:
-            self.keys.append(key)
-            self._set_option_biff_keys()
+    def get_key_by_name(self, name):
+        for key, values in self.snapshot.biff.iteritems():
+            if values['name'] == name:
+                return key
+
+    def get_filename_matcher(self):
+        mp = self.ticket_custom_config.get_matching_pattern_value()
+        return matcher.get_filename_matcher(self.env, mp)
 
+    def migrate_ini_to_db(self):
+        """Move File Biff settings in trac.ini into the database."""
+        ini_store = IniBiffStore(self.env, self.config)
+        biff = ini_store.load()
+        if not biff:
+            return 0
+
+        db_store = DbBiffStore(self.env)
+        with self.env.db_transaction:
+            for values in biff:
+                if db_store.get_name(values['key']) is None:
+                    db_store.insert(values['key'], values)
+        ini_store.delete([values['key'] for values in biff])
+        self.config.remove(self.SECTION, self.BIFF_KEYS)
+        self.config.save()
+        self._changed()
+        return len(biff)
+
+
+class IniBiffStore(object):
+    """Store of File Biff settings in [changefilebiff] section."""
+
+    SECTION = ChangefileBiffConfig.SECTION
+    BIFF_KEYS = ChangefileBiffConfig.BIFF_KEYS
+    BIFF_OPTION = ChangefileBiffConfig.BIFF_OPTION
+    BIFF_FIELDS = ChangefileBiffConfig.BIFF_FIELDS
+
+    generation = None  # the modification time of trac.ini is used
+    needs_config_save = True
+
+    def __init__(self, env, config):
+        self.env = env
+        self.config = config
+        self.keys = self.config.getlist(self.SECTION, self.BIFF_KEYS, [])
+
+    def load(self):
+        def get_value(option, is_multiple):
+            if is_multiple:
+                rv = u', '.join(self.config.getlist(self.SECTION, option, []))
+            else:
+                rv = self.config.get(self.SECTION, option, '')
+            return rv
+
+        biff = []
+        for key in self.keys:
+            values = {'key': key}
+            for field in self.BIFF_FIELDS:
+                id_ = field['id']
+                option = self.BIFF_OPTION % (key, id_)
+                values[id_] = get_value(option, field['multiple'])
+            biff.append(values)
+        return biff
+
+    def get_name(self, key):
+        option = self.BIFF_OPTION % (key, 'name')
+        return self.config.get(self.SECTION, option, '')
+
+    def insert(self, key, values):
+        self.keys.append(key)
+        self._set_option_biff_keys()
+        self.update(key, values)
+
+    def update(self, key, values):
         for field in self.BIFF_FIELDS:
             id_ = field['id']
-            value = opt_value.get(id_, u'')
-            if field['multiple'] and isinstance(value, (list, tuple)):
-                value = u', '.join(value)
             option = self.BIFF_OPTION % (key, id_)
-            self.config.set(self.SECTION, option, value)
+            self.config.set(self.SECTION, option, values.get(id_, u''))
 
-    def save(self):
-        self.config.save()
+    def delete(self, keys):
+        for key in keys:
+            self.remove_option(key)
 
     def remove_option(self, key):
         try:
@@ -119,9 +272,277 @@ class ChangefileBiffConfig(object):
     def _set_option_biff_keys(self):
         self.config.set(self.SECTION, self.BIFF_KEYS, u', '.join(self.keys))
 
-    def get_filename_matcher(self):
-        mp = self.ticket_custom_config.get_matching_pattern_value()
-        return matcher.get_filename_matcher(self.env, mp)
+
+class DbBiffStore(object):
+    """Store of File Biff settings in filebiff table."""
+
+    GENERATION = 'changefilebiff_generation'  # name in system table
+    COLUMNS = ('id', 'name', 'cc', 'filename', 'repository')
+
+    needs_config_save = False
+
+    def __init__(self, env):
+        self.env = env
+
+    @property
+    def generation(self):
+        for value, in self.env.db_query("""
+                SELECT value FROM system WHERE name=%s
+                """, (self.GENERATION,)):
+            return value
+
+    def load(self):
+        return [self._to_values(row) for row in self.env.db_query("""
+                SELECT %s FROM filebiff ORDER BY name
+                """ % ','.join(self.COLUMNS))]
+
+    def get(self, key):
+        for row in self.env.db_query("""
+                SELECT %s FROM filebiff WHERE id=%%s
+                """ % ','.join(self.COLUMNS), (key,)):
+            return self._to_values(row)
+
+    def get_name(self, key):
+        values = self.get(key)
+        return values['name'] if values else None
+
+    def insert(self, key, values):
+        with self.env.db_transaction as db:
+            db("INSERT INTO filebiff (%s) VALUES (%s)"
+               % (','.join(self.COLUMNS),
+                  ','.join(['%s'] * len(self.COLUMNS))),
+               [key] + [values.get(c, u'') for c in self.COLUMNS[1:]])
+            self._update_generation(db)
+
+    def update(self, key, values):
+        with self.env.db_transaction as db:
+            db("UPDATE filebiff SET %s WHERE id=%%s"
+               % ','.join('%s=%%s' % c for c in self.COLUMNS[1:]),
+               [values.get(c, u'') for c in self.COLUMNS[1:]] + [key])
+            self._update_generation(db)
+
+    def delete(self, keys):
+        with self.env.db_transaction as db:
+            db.executemany("DELETE FROM filebiff WHERE id=%s",
+                           [(key,) for key in keys])
+            self._update_generation(db)
+
+    def _update_generation(self, db):
+        # a random value is unique enough to notice the change in other
+        # processes without reading and incrementing a counter
+        db("UPDATE system SET value=%s WHERE name=%s",
+           (hex_entropy(16), self.GENERATION))
+
+    def _to_values(self, row):
+        values = dict(zip(self.COLUMNS, row))
+        values['key'] = values.pop('id')
+        return values
+
+
+class BiffSnapshot(object):
+    """Immutable snapshot of File Biff settings and the compiled matcher.
+
+    The dict of each biff must not be modified since a snapshot is shared
+    by the change listener and the admin page.
+    """
+
+    SORT_FIELDS = ('name', 'cc', 'filename', 'repository')
+
+    def __init__(self, version, keys, biff, matching_pattern,
+                 path_cache_size=matcher.DEFAULT_PATH_CACHE_SIZE):
+        self.version = version
+        self.keys = tuple(keys)
+        self.biff = biff
+        self.matching_pattern = matching_pattern
+        self.path_cache_size = path_cache_size
+        self._indexes = {}  # repository name -> index
+        self._sorted_keys = {}  # field -> keys sorted by the field
+
+    def get_biff_patterns(self, reponame=None):
+        """Return pairs of (biff key, filename patterns) of the biffs for
+        the repository, or all biffs if reponame is None.
+        """
+        return [(key, split_values(self.biff[key]['filename']))
+                for key in self.keys
+                if reponame is None or self.in_scope(key, reponame)]
+
+    def in_scope(self, key, reponame):
+        """Return True if the biff applies to the repository, the biff
+        without repository applies to all repositories.
+        """
+        scope = split_values(self.biff[key].get('repository') or '')
+        return not scope or (reponame or DEFAULT_REPOSITORY) in scope
+
+    @lazy
+    def names(self):
+        """Dict of biff name -> biff key."""
+        return dict((self.biff[key]['name'], key) for key in self.keys)
+
+    @lazy
+    def patterns(self):
+        """Dict of filename pattern -> set of biff keys."""
+        patterns = {}
+        for key, biff_patterns in self.get_biff_patterns():
+            for pattern in biff_patterns:
+                patterns.setdefault(pattern, set()).add(key)
+        return patterns
+
+    @lazy
+    def search_values(self):
+        """Dict of biff key -> lower case name, cc users and filename
+        patterns to search.
+        """
+        values = {}
+        for key in self.keys:
+            biff = self.biff[key]
+            values[key] = [biff['name'].lower()] + \
+                          [v.lower() for field in ('cc', 'filename')
+                           for v in split_values(biff[field] or '')]
+        return values
+
+    def search(self, query=None, sort='name', asc=True):
+        """Return the biffs sorted by the field whose name, cc or filename
+        contains query, or matches it if query is a glob pattern.
+        """
+        if sort not in self.SORT_FIELDS:
+            sort = 'name'
+        keys = self._sorted_keys.get(sort)
+        if keys is None:
+            keys = sorted(self.keys, key=lambda k: (
+                (self.biff[k].get(sort) or '').lower(),
+                self.biff[k]['name']))
+            self._sorted_keys[sort] = keys
+        if not asc:
+            keys = keys[::-1]
+
+        if query:
+            query = query.lower()
+            if matcher.has_glob(query):
+                def match(value):
+                    return fnmatchcase(value, query)
+            else:
+                def match(value):
+                    return query in value
+            keys = [key for key in keys
+                    if any(match(v) for v in self.search_values[key])]
+        return [self.biff[key] for key in keys]
+
+    def find_overlaps(self, env, patterns, exclude_key=None):
+        """Return a list of (pattern, biff key, other pattern) of the biffs
+        matching to some files of patterns. other pattern is the one of
+        the biff whose files are all matched by pattern, or None if the
+        files partially overlap.
+
+        Each pattern is tested with a sample path of the other one by the
+        compiled matcher, so it reports nothing if a sample is unknown.
+        """
+        filename_matcher = matcher.get_filename_matcher(
+            env, self.matching_pattern)
+        overlaps = set()
+        index = self.get_index(env, cached=False)
+        for pattern in patterns:
+            path = filename_matcher.sample_path(pattern)
+            if path is not None:
+                overlaps.update((pattern, key, None)
+                                for key in index.match_path(path)
+                                if key != exclude_key)
+
+        new_index = filename_matcher.compile(
+            [(pattern, [pattern]) for pattern in patterns])
+        for key, biff_patterns in self.get_biff_patterns():
+            if key == exclude_key:
+                continue
+            for other in biff_patterns:
+                path = filename_matcher.sample_path(other)
+                if path is None:
+                    continue
+                for pattern in new_index.match_path(path):
+                    if pattern != other:
+                        overlaps.discard((pattern, key, None))
+                        overlaps.add((pattern, key, other))
+        return sorted(overlaps)
+
+    def get_index(self, env, reponame=None, cached=True):
+        """Return the matcher index of the biffs for the repository, it is
+        compiled at the first call for each repository.
+
+        The index memoizes the matched biffs for each path unless cached
+        is False or the size of the path cache is 0.
+        """
+        index = self._indexes.get(reponame)
+        if index is None:
+            filename_matcher = matcher.get_filename_matcher(
+                env, self.matching_pattern)
+            index = filename_matcher.compile(
+                self.get_biff_patterns(reponame))
+            for key, pattern, error in index.invalid:
+                env.log.warn("Ignored the pattern '%s' of File Biff '%s': "
+                             "%s", pattern, self.biff[key]['name'], error)
+            self._indexes[reponame] = index
+        if cached and self.path_cache_size > 0:
+            cache = matcher.get_path_cache(env.path, self.path_cache_size)
+            return matcher.CachedIndex(index, (self.version, reponame),
+                                       cache)
+        return index
+
+
+DEFAULT_REPOSITORY = '(default)'
+
+
+def split_values(value):
+    """Split comma separated value into stripped values."""
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+DEFAULT_TICKET_BATCH_SIZE = 50
+DEFAULT_BULK_BATCH_SIZE = 1000
+
+
+def update_tickets(env, tkt_ids, update, author, comment, date,
+                   batch_size=DEFAULT_TICKET_BATCH_SIZE):
+    """Update tickets in transactions of batch_size tickets.
+
+    update(ticket) changes the ticket and returns True when it should be
+    saved. When a transaction fails, the tickets in it are updated one by
+    one again, so that a ticket failure doesn't affect the other ones. A
+    ticket which doesn't exist, e.g. `refs #99999`, is skipped without
+    failing the transaction.
+    """
+    stats = ChangefileBiffStats(env).recorder
+
+    def update_ticket(tkt_id):
+        with stats.timer('ticket_load'):
+            try:
+                ticket = Ticket(env, tkt_id)
+            except ResourceNotFound:
+                env.log.warn('Ticket #%s does not exist', tkt_id)
+                return
+        if update(ticket):
+            with stats.timer('save_changes'):
+                ticket.save_changes(author, comment, date)
+            stats.incr('tickets_touched')
+
+    tkt_ids = list(tkt_ids)
+    batch_size = max(1, batch_size)
+    for i in range(0, len(tkt_ids), batch_size):
+        batch = tkt_ids[i:i + batch_size]
+        try:
+            with env.db_transaction:
+                for tkt_id in batch:
+                    update_ticket(tkt_id)
+        except Exception as e:
+            if len(batch) == 1:
+                env.log.error('Failed to update ticket #%s: %s',
+                              batch[0], exception_to_unicode(e))
+                continue
+            for tkt_id in batch:
+                try:
+                    with env.db_transaction:
+                        update_ticket(tkt_id)
+                except Exception as e:
+                    env.log.error('Failed to update ticket #%s: %s',
+                                  tkt_id, exception_to_unicode(e))
+
 
 class TicketCustomFileBiffConfig(object):
     """Configuration model to handle [ticket-custom] section in trac.ini."""
@@ -140,10 +561,6 @@ class TicketCustomFileBiffConfig(object):
         ],
     }
 
-    GET_TICKET_ID_FROM_TICKET_CUSTOM = """
-        SELECT ticket FROM ticket_custom WHERE name=%s AND value LIKE %s
-    """.strip()
-
     def __init__(self, env, config):
         self.env = env
         self.config = config
@@ -179,24 +596,27 @@ class TicketCustomFileBiffConfig(object):
             values.add(value)
             self.set_fb_options(values)
 
-    def update_options_value(self, authname, old_value, new_value):
+    def update_options_value(self, authname, old_value, new_value,
+                             progress=None):
         values = self.get_options_value()
         if old_value in values:
             values.discard(old_value)
             values.add(new_value)
             self.set_fb_options(values)
-            self.update_ticket_field(authname, old_value, new_value)
+            self.update_ticket_field(authname, old_value, new_value, progress)
 
-    def update_ticket_field(self, authname, old_value, new_value):
+    def update_ticket_field(self, authname, old_value, new_value,
+                            progress=None):
         ticket_ids = self._get_ticket_ids(old_value)
         if not ticket_ids:
             return
 
         comment = _('Updated File Biff field value by Trac administrator.')
         fb_methodcaller = methodcaller('update', old_value, new_value)
-        self._update_field(authname, comment, ticket_ids, fb_methodcaller)
+        self._update_field(authname, comment, ticket_ids, fb_methodcaller,
+                           progress)
 
-    def remove_options_value(self, authname, remove_values):
+    def remove_options_value(self, authname, remove_values, progress=None):
         values = self.get_options_value()
         has_remove_value = False
         for value in remove_values:
@@ -206,9 +626,9 @@ class TicketCustomFileBiffConfig(object):
 
         if has_remove_value:
             self.set_fb_options(values)
-            self.remove_ticket_field(authname, remove_values)
+            self.remove_ticket_field(authname, remove_values, progress)
 
-    def remove_ticket_field(self, authname, remove_values):
+    def remove_ticket_field(self, authname, remove_values, progress=None):
         for value in remove_values:
             ticket_ids = self._get_ticket_ids(value)
             if not ticket_ids:
@@ -216,7 +636,8 @@ class TicketCustomFileBiffConfig(object):
 
             comment = _('Removed File Biff field value by Trac administrator.')
             fb_methodcaller = methodcaller('remove', value)
-            self._update_field(authname, comment, ticket_ids, fb_methodcaller)
+            self._update_field(authname, comment, ticket_ids, fb_methodcaller,
+                               progress)
 
     def set_fb_options(self, values):
         updated_values = u' '.join(sorted(list(values)))
@@ -227,37 +648,426 @@ class TicketCustomFileBiffConfig(object):
 
     def _get_ticket_ids(self, value):
         ticket_ids = []
-        sql = self.GET_TICKET_ID_FROM_TICKET_CUSTOM
-        params = (self.CUSTOM_FIELDS['id'], '%%%s%%' % value)
         try:
-            with self.env.db_query as db:
-                ticket_ids = [id_ for id_ in db(sql, params)]
+            ticket_ids = FileBiffTicketIndex(self.env).get_ticket_ids(value)
         except Exception as e:
             self.env.log.error('Failed to get ticket ids: '
-                               'sql: %s, params: %s, exception: %s',
-                               sql, params, exception_to_unicode(e))
+                               'value: %s, exception: %s',
+                               value, exception_to_unicode(e))
         return ticket_ids
 
-    def _update_field(self, authname, comment, ticket_ids, fb_methodcaller):
-        date = datetime.now(utc)
-        for tkt_id in chain.from_iterable(ticket_ids):
+    def _update_field(self, authname, comment, ticket_ids, fb_methodcaller,
+                      progress=None):
+        """Change the field values of tickets by set-based SQL in chunks
+        of `[changefilebiff] bulk_batch_size` tickets.
+
+        Each chunk is committed with filebiff_ticket index, so that the
+        remaining tickets are found again if it is interrupted. Note that
+        ITicketChangeListener is not notified for the changes.
+        """
+        field_name = self.CUSTOM_FIELDS['id']
+        from api import ChangefileBiffModule
+        batch_size = max(1, ChangefileBiffModule(self.env).bulk_batch_size)
+        when = to_utimestamp(datetime.now(utc))
+        ticket_ids = list(ticket_ids)
+        stats = ChangefileBiffStats(self.env)
+        for i in range(0, len(ticket_ids), batch_size):
+            chunk = ticket_ids[i:i + batch_size]
             try:
-                with self.env.db_transaction:
-                    ticket = Ticket(self.env, tkt_id)
-                    fb_field = FileBiffTicketCustomField(ticket)
-                    fb_methodcaller(fb_field)
-                    if fb_field.is_updated:
-                        ticket.save_changes(authname, comment, date)
+                with self.env.db_transaction as db:
+                    changes = []
+                    for tkt_id, value in db("""
+                            SELECT ticket, value FROM ticket_custom
+                            WHERE name=%%s AND ticket IN (%s)
+                            """ % ','.join(['%s'] * len(chunk)),
+                            [field_name] + chunk):
+                        fb_field = FileBiffTicketCustomField(
+                            _FieldValues({field_name: value}))
+                        fb_methodcaller(fb_field)
+                        if fb_field.is_updated:
+                            new_value = fb_field.ticket[field_name]
+                            changes.append((tkt_id, value, new_value))
+                    with stats.recorder.timer('update_field'):
+                        self._save_changes(db, authname, comment, when,
+                                           changes)
+                    stats.recorder.incr('tickets_touched', len(changes))
             except Exception as e:
                 self.env.log.error(
                     'Failed to update ticket file biff field value: '
-                    'tkt id: %s, authname: %s, exception: %s',
-                    tkt_id, authname, exception_to_unicode(e))
+                    'tkt ids: %s-%s, authname: %s, exception: %s',
+                    chunk[0], chunk[-1], authname, exception_to_unicode(e))
+            if progress:
+                progress(i + len(chunk), len(ticket_ids))
+        stats.flush('update_field')
+
+    def _save_changes(self, db, authname, comment, when, changes):
+        if not changes:
+            return
+
+        field_name = self.CUSTOM_FIELDS['id']
+        tkt_ids = [tkt_id for tkt_id, __, __ in changes]
+        holders = ','.join(['%s'] * len(tkt_ids))
+        # Ticket.save_changes() records a comment for each change, the
+        # number is derived from the last comment in the same way
+        cnums, found = {}, set()
+        for tkt_id, __, oldvalue in db("""
+                SELECT DISTINCT tc1.ticket, tc1.time,
+                                COALESCE(tc2.oldvalue, '')
+                FROM ticket_change AS tc1
+                LEFT OUTER JOIN ticket_change AS tc2
+                ON tc2.ticket=tc1.ticket AND tc2.time=tc1.time
+                   AND tc2.field='comment'
+                WHERE tc1.ticket IN (%s) ORDER BY tc1.ticket, tc1.time DESC
+                """ % holders, tkt_ids):
+            if tkt_id in found:
+                continue
+            try:
+                num = int(oldvalue.rsplit('.', 1)[-1])
+                found.add(tkt_id)
+            except ValueError:
+                num = 1
+            cnums[tkt_id] = cnums.get(tkt_id, 0) + num
+
+        db.executemany("""
+            UPDATE ticket_custom SET value=%s WHERE ticket=%s AND name=%s
+            """, [(new, tkt_id, field_name) for tkt_id, __, new in changes])
+        db("UPDATE ticket SET changetime=%%s WHERE id IN (%s)" % holders,
+           [when] + tkt_ids)
+        db.executemany("""
+            INSERT INTO ticket_change
+              (ticket, time, author, field, oldvalue, newvalue)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            """, [(tkt_id, when, authname, field_name, old, new)
+                  for tkt_id, old, new in changes] +
+                 [(tkt_id, when, authname, 'comment',
+                   str(cnums.get(tkt_id, 0) + 1), comment)
+                  for tkt_id in tkt_ids])
+        FileBiffTicketIndex(self.env).sync_many(
+            (tkt_id, new.split()) for tkt_id, __, new in changes)
 
     def get_matching_pattern_value(self):
         return self.config.get(self.SECTION, self.fb_matching_pattern, '')
 
 
+class ChangesetQueue(object):
+    """Persistent queue of the changesets to be processed asynchronously."""
+
+    def __init__(self, env):
+        self.env = env
+
+    def enqueue(self, reponame, rev):
+        now = to_utimestamp(datetime.now(utc))
+        with self.env.db_transaction as db:
+            db("""INSERT INTO filebiff_queue
+                  (repos, rev, time, next_time, attempts, error)
+                  VALUES (%s, %s, %s, %s, 0, '')
+                  """, (reponame, rev, now, now))
+
+    def depth(self, max_attempts):
+        for count, in self.env.db_query("""
+                SELECT COUNT(*) FROM filebiff_queue WHERE attempts<%s
+                """, (max_attempts,)):
+            return count
+
+    def status(self, max_attempts):
+        """Return a dict of the number of pending and failed changesets,
+        and the enqueued time of the oldest pending one.
+        """
+        rv = {'pending': 0, 'failed': 0, 'oldest': None}
+        with self.env.db_query as db:
+            for count, oldest in db("""
+                    SELECT COUNT(*), MIN(time) FROM filebiff_queue
+                    WHERE attempts<%s""", (max_attempts,)):
+                rv['pending'], rv['oldest'] = count, oldest
+            for count, in db("""
+                    SELECT COUNT(*) FROM filebiff_queue WHERE attempts>=%s
+                    """, (max_attempts,)):
+                rv['failed'] = count
+        return rv
+
+    def claim(self, max_attempts, lease, limit=None):
+        """Return the changesets which are due, they are locked for lease
+        microseconds so that concurrent drains don't process them twice.
+        """
+        now = to_utimestamp(datetime.now(utc))
+        sql = """SELECT id, repos, rev, time, next_time, attempts
+                 FROM filebiff_queue WHERE next_time<=%s AND attempts<%s
+                 ORDER BY id"""
+        if limit:
+            sql += " LIMIT %d" % limit
+
+        items = []
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            for row in db(sql, (now, max_attempts)):
+                id_, next_time = row[0], row[4]
+                cursor.execute("""
+                    UPDATE filebiff_queue SET next_time=%s
+                    WHERE id=%s AND next_time=%s
+                    """, (now + lease, id_, next_time))
+                if cursor.rowcount == 1:
+                    items.append(row[:4] + row[5:])
+        return items
+
+    def done(self, id_):
+        with self.env.db_transaction as db:
+            db("DELETE FROM filebiff_queue WHERE id=%s", (id_,))
+
+    def retry(self, id_, attempts, delay, error):
+        next_time = to_utimestamp(datetime.now(utc)) + delay
+        with self.env.db_transaction as db:
+            db("""UPDATE filebiff_queue SET attempts=%s, next_time=%s, error=%s
+                  WHERE id=%s""", (attempts, next_time, error, id_))
+
+    def reset_failed(self, max_attempts):
+        now = to_utimestamp(datetime.now(utc))
+        with self.env.db_transaction as db:
+            db("""UPDATE filebiff_queue SET attempts=0, next_time=%s
+                  WHERE attempts>=%s""", (now, max_attempts))
+
+
+class PendingTicketUpdates(object):
+    """File Biff values and cc of the tickets merged across changesets
+    until they are written as one ticket change.
+    """
+
+    def __init__(self, env):
+        self.env = env
+
+    def add(self, tkt_ids, author, biff_names, biff_cc):
+        """Merge biff_names and cc users of biff_cc into the tickets, the
+        time of the first change is kept.
+        """
+        now = to_utimestamp(datetime.now(utc))
+        cc_users = [user for cc in biff_cc for user in split_values(cc)]
+        with self.env.db_transaction as db:
+            for tkt_id in tkt_ids:
+                for biffs, cc in db("""
+                        SELECT biffs, cc FROM filebiff_pending
+                        WHERE ticket=%s""", (tkt_id,)):
+                    db("""UPDATE filebiff_pending SET author=%s, biffs=%s,
+                          cc=%s WHERE ticket=%s
+                          """, (author, _merge(biffs.split(), biff_names, ' '),
+                                _merge(split_values(cc), cc_users, ', '),
+                                tkt_id))
+                    break
+                else:
+                    db("""INSERT INTO filebiff_pending
+                          (ticket, author, biffs, cc, time)
+                          VALUES (%s, %s, %s, %s, %s)
+                          """, (tkt_id, author, _merge([], biff_names, ' '),
+                                _merge([], cc_users, ', '), now))
+
+    def count(self):
+        for count, in self.env.db_query("""
+                SELECT COUNT(*) FROM filebiff_pending"""):
+            return count
+
+    def get_due(self, before=None):
+        """Return pairs of (ticket id, author) first changed before the
+        time in microseconds, all of them if before is None.
+        """
+        sql = "SELECT ticket, author FROM filebiff_pending"
+        args = ()
+        if before is not None:
+            sql += " WHERE time<=%s"
+            args = (before,)
+        return list(self.env.db_query(sql + " ORDER BY time, ticket", args))
+
+    def discard_missing(self):
+        """Delete the tickets which don't exist."""
+        with self.env.db_transaction as db:
+            db("""DELETE FROM filebiff_pending
+                  WHERE ticket NOT IN (SELECT id FROM ticket)""")
+
+    def pop(self, tkt_id):
+        """Return (biff names, cc users) of the ticket and delete them in
+        the transaction of the caller, or None if not pending.
+        """
+        with self.env.db_transaction as db:
+            for biffs, cc in db("""
+                    SELECT biffs, cc FROM filebiff_pending WHERE ticket=%s
+                    """, (tkt_id,)):
+                db("DELETE FROM filebiff_pending WHERE ticket=%s", (tkt_id,))
+                return biffs.split(), split_values(cc)
+
+
+class BiffHits(object):
+    """Number of the changesets matched by each biff per day and
+    repository.
+
+    The totals of each biff are kept in the rows of day 0 as well, so
+    they are read without aggregating the days. The biffs counted for each
+    changeset are kept in filebiff_hit_changeset, so that a changeset is
+    never counted twice by resync or a retry of the queue.
+    """
+
+    DAY = 24 * 60 * 60 * 1000000  # microseconds
+
+    def __init__(self, env):
+        self.env = env
+
+    def record(self, keys, reponame, rev, when):
+        """Count the changeset matched by the biffs at the time of when,
+        unless the biff has counted it.
+        """
+        reponame = reponame or ''
+        time = to_utimestamp(when)
+        buckets = ((reponame, time // self.DAY), ('', 0))
+        with self.env.db_transaction as db:
+            counted = None
+            for biffs, in db("""
+                    SELECT biffs FROM filebiff_hit_changeset
+                    WHERE repos=%s AND rev=%s""", (reponame, rev)):
+                counted = set(biffs.split())
+            keys = set(keys) - (counted or set())
+            if not keys:
+                return
+            if counted is None:
+                db("""INSERT INTO filebiff_hit_changeset (repos, rev, biffs)
+                      VALUES (%s, %s, %s)""",
+                   (reponame, rev, ' '.join(sorted(keys))))
+            else:
+                db("""UPDATE filebiff_hit_changeset SET biffs=%s
+                      WHERE repos=%s AND rev=%s""",
+                   (' '.join(sorted(counted | keys)), reponame, rev))
+
+            cursor = db.cursor()
+            for key in sorted(keys):
+                for repos, day in buckets:
+                    # resync counts the past changesets
+                    cursor.execute("""
+                        UPDATE filebiff_hits SET hits=hits+1,
+                        last_hit=CASE WHEN last_hit<%s THEN %s
+                                      ELSE last_hit END
+                        WHERE biff=%s AND repos=%s AND day=%s
+                        """, (time, time, key, repos, day))
+                    if cursor.rowcount == 0:
+                        cursor.execute("""
+                            INSERT INTO filebiff_hits
+                            (biff, repos, day, hits, last_hit)
+                            VALUES (%s, %s, %s, 1, %s)
+                            """, (key, repos, day, time))
+
+    def get_totals(self, days=None):
+        """Return a dict of biff key -> (hits, last hit time) of all time,
+        or the last days.
+        """
+        if days is None:
+            rows = self.env.db_query("""
+                SELECT biff, hits, last_hit FROM filebiff_hits
+                WHERE day=0""")
+        else:
+            since = to_utimestamp(datetime.now(utc)) // self.DAY - days + 1
+            rows = self.env.db_query("""
+                SELECT biff, SUM(hits), MAX(last_hit) FROM filebiff_hits
+                WHERE day>=%s GROUP BY biff""", (max(1, since),))
+        return dict((key, (hits, from_utimestamp(last_hit)))
+                    for key, hits, last_hit in rows)
+
+    def delete(self, keys):
+        with self.env.db_transaction as db:
+            db.executemany("DELETE FROM filebiff_hits WHERE biff=%s",
+                           [(key,) for key in keys])
+
+
+def _merge(values, add_values, sep):
+    values = list(values)
+    for value in add_values:
+        if value not in values:
+            values.append(value)
+    return sep.join(values)
+
+
+class FileBiffTicketIndex(object):
+    """Index of the tickets for each value of the File Biff field."""
+
+    def __init__(self, env):
+        self.env = env
+
+    def get_ticket_ids(self, name):
+        return [id_ for id_, in self.env.db_query("""
+                SELECT ticket FROM filebiff_ticket WHERE name=%s
+                ORDER BY ticket""", (name,))]
+
+    def sync(self, tkt_id, values):
+        """Replace the index entries of the ticket with values."""
+        with self.env.db_transaction as db:
+            db("DELETE FROM filebiff_ticket WHERE ticket=%s", (tkt_id,))
+            db.executemany("""
+                INSERT INTO filebiff_ticket (name, ticket) VALUES (%s, %s)
+                """, [(value, tkt_id) for value in set(values)])
+
+    def sync_many(self, items):
+        """Replace the index entries by pairs of (ticket id, values)."""
+        items = list(items)
+        with self.env.db_transaction as db:
+            db.executemany("DELETE FROM filebiff_ticket WHERE ticket=%s",
+                           [(tkt_id,) for tkt_id, __ in items])
+            db.executemany("""
+                INSERT INTO filebiff_ticket (name, ticket) VALUES (%s, %s)
+                """, [(value, tkt_id)
+                      for tkt_id, values in items for value in set(values)])
+
+    def delete(self, tkt_id):
+        with self.env.db_transaction as db:
+            db("DELETE FROM filebiff_ticket WHERE ticket=%s", (tkt_id,))
+
+    def rebuild(self):
+        """Rebuild the index from ticket_custom table."""
+        field_name = TicketCustomFileBiffConfig.CUSTOM_FIELDS['id']
+        with self.env.db_transaction as db:
+            db("DELETE FROM filebiff_ticket")
+            rows = set()
+            for tkt_id, value in db("""
+                    SELECT ticket, value FROM ticket_custom WHERE name=%s
+                    """, (field_name,)):
+                rows.update((v, tkt_id) for v in (value or '').split())
+            db.executemany("""
+                INSERT INTO filebiff_ticket (name, ticket) VALUES (%s, %s)
+                """, sorted(rows))
+        return len(rows)
+
+
+class ResyncCheckpoint(object):
+    """The last revision processed by resync of a repository and the stop
+    revision of the run, which is None when the run has been done.
+    """
+
+    def __init__(self, env, reponame):
+        self.env = env
+        self.name = 'changefilebiff_resync:%s' % reponame
+
+    def get(self):
+        """Return (last revision, stop revision) or (None, None)."""
+        for value, in self.env.db_query("""
+                SELECT value FROM system WHERE name=%s""", (self.name,)):
+            # the revisions never contain whitespace
+            rev, __, stop = value.partition(' ')
+            return rev, stop or None
+        return None, None
+
+    def set(self, rev, stop=None):
+        value = rev if stop is None else u'%s %s' % (rev, stop)
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("UPDATE system SET value=%s WHERE name=%s",
+                           (value, self.name))
+            if cursor.rowcount == 0:
+                cursor.execute("""
+                    INSERT INTO system (name, value) VALUES (%s, %s)
+                    """, (self.name, value))
+
+
+class _FieldValues(dict):
+    """Stand-in of Ticket for FileBiffTicketCustomField to change the field
+    value without loading the ticket.
+    """
+
+    def get_value_or_default(self, name):
+        return self.get(name)
+
+
 class FileBiffTicketCustomField(object):
     """File Biff field model to handle the ticket custom field."""
 
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+
+from trac.config import BoolOption
+from trac.core import Component
+from trac.util.text import exception_to_unicode
+
+# upper bounds in seconds of latency histogram buckets, the last is +inf
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, None)
+
+
+class StatsRecorder(object):
+    """Counters and latency histograms which are not flushed yet."""
+
+    enabled = True
+
+    def __init__(self):
+        self._lock = Lock()
+        self._reset()
+
+    def _reset(self):
+        self.counters = defaultdict(int)
+        self.latencies = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self.totals = defaultdict(int)  # microseconds
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if bound is None or seconds <= bound:
+                    self.latencies[phase][i] += 1
+                    break
+            self.totals[phase] += int(seconds * 1000000)
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.time() - start)
+
+    def count_iter(self, name, iterable):
+        """Count the items of iterable as they are consumed."""
+        count = 0
+        try:
+            for item in iterable:
+                count += 1
+                yield item
+        finally:
+            self.incr(name, count)
+
+    def pop(self):
+        """Return the rows of (name, bucket, value) and reset them."""
+        with self._lock:
+            rows = [(name, '', value)
+                    for name, value in self.counters.iteritems()]
+            for phase, counts in self.latencies.iteritems():
+                rows.extend(('latency.' + phase, _bucket_name(bound), count)
+                            for bound, count in zip(LATENCY_BUCKETS, counts)
+                            if count)
+                rows.append(('latency.' + phase, 'total', self.totals[phase]))
+            self._reset()
+        return rows
+
+
+class NullStatsRecorder(object):
+    """Recorder used while the statistics are disabled."""
+
+    enabled = False
+
+    def incr(self, name, value=1):
+        pass
+
+    def observe(self, phase, seconds):
+        pass
+
+    def timer(self, phase):
+        return _null_timer
+
+    def count_iter(self, name, iterable):
+        return iterable
+
+    def pop(self):
+        return []
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_timer = _NullTimer()
+_null_recorder = NullStatsRecorder()
+
+
+def _bucket_name(bound):
+    return '+inf' if bound is None else str(bound)
+
+
+class ChangefileBiffStats(Component):
+    """Statistics of File Biff processing stored in filebiff_stats table."""
+
+    enabled = BoolOption(
+        'changefilebiff', 'stats', 'false',
+        """Record the latency of each processing phase and the number of
+        scanned files, matched biffs and touched tickets. They are shown
+        by `trac-admin $ENV filebiff stats` and the admin page.""")
+
+    log_enabled = BoolOption(
+        'changefilebiff', 'stats_log', 'false',
+        """Write the statistics of each operation into the log as a JSON
+        line, it works only if `stats` is enabled.""")
+
+    def __init__(self):
+        self._recorder = StatsRecorder()
+
+    @property
+    def recorder(self):
+        return self._recorder if self.enabled else _null_recorder
+
+    def flush(self, operation):
+        """Add the recorded values into filebiff_stats table."""
+        rows = self.recorder.pop()
+        if not rows:
+            return
+        if self.log_enabled:
+            self.log.info('filebiff stats: %s', json.dumps({
+                'operation': operation,
+                'stats': dict(('%s:%s' % (name, bucket) if bucket else name,
+                               value) for name, bucket, value in rows),
+            }, sort_keys=True))
+        try:
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                for name, bucket, value in rows:
+                    cursor.execute("""
+                        UPDATE filebiff_stats SET value=value+%s
+                        WHERE name=%s AND bucket=%s
+                        """, (value, name, bucket))
+                    if cursor.rowcount == 0:
+                        cursor.execute("""
+                            INSERT INTO filebiff_stats (name, bucket, value)
+                            VALUES (%s, %s, %s)
+                            """, (name, bucket, value))
+        except Exception as e:
+            self.log.warn('Failed to save File Biff statistics: %s',
+                          exception_to_unicode(e))
+
+    def get_counters(self):
+        return sorted((name, value) for name, bucket, value
+                      in self.env.db_query("""
+                        SELECT name, bucket, value FROM filebiff_stats
+                        WHERE name NOT LIKE 'latency.%'"""))
+
+    def get_latencies(self):
+        """Return a list of (phase, count, average, 50th percentile, 95th
+        percentile) of the latency in seconds. The percentiles are upper
+        bounds of the buckets, None means more than the largest one.
+        """
+        buckets = defaultdict(dict)
+        for name, bucket, value in self.env.db_query("""
+                SELECT name, bucket, value FROM filebiff_stats
+                WHERE name LIKE 'latency.%'"""):
+            buckets[name[len('latency.'):]][bucket] = value
+
+        rows = []
+        for phase in sorted(buckets):
+            counts = [buckets[phase].get(_bucket_name(bound), 0)
+                      for bound in LATENCY_BUCKETS]
+            count = sum(counts)
+            if not count:
+                continue
+            average = buckets[phase].get('total', 0) / 1000000.0 / count
+            rows.append((phase, count, average,
+                         self._percentile(counts, count, 0.5),
+                         self._percentile(counts, count, 0.95)))
+        return rows
+
+    def reset(self):
+        self._recorder.pop()
+        with self.env.db_transaction as db:
+            db("DELETE FROM filebiff_stats")
+
+    def _percentile(self, counts, total, ratio):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, counts):
+            cumulative += count
+            if cumulative >= total * ratio:
+                return bound
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+
+from trac.core import Component, implements
+from trac.perm import IPermissionRequestor
+from trac.web.api import HTTPBadRequest, IRequestHandler
+
+from api import _
+from api import ChangefileBiffRepositoryChangeListener
+from model import DEFAULT_REPOSITORY
+
+# size of the request body read at once
+READ_SIZE = 65536
+
+
+class ChangefileBiffMatchHandler(Component):
+    """Tell which File Biff settings would be applied to a changeset.
+
+    POST the changed paths separated by newline to `/filebiff/match` as
+    text/plain in UTF-8 with FILEBIFF_MATCH permission, the optional
+    `repos` query argument is the repository name. It returns the matched
+    settings in JSON like this.
+
+        {"biffs": [{"cc": ["user1"], "name": "text-files"}],
+         "cc": ["user1"], "paths": 2}
+    """
+
+    implements(IPermissionRequestor, IRequestHandler)
+
+    # IPermissionRequestor methods
+    def get_permission_actions(self):
+        # the names and cc users are shown only to the admins by default
+        return ['FILEBIFF_MATCH']
+
+    # IRequestHandler methods
+    def match_request(self, req):
+        return re.match(r'/filebiff/match/?$', req.path_info) is not None
+
+    def process_request(self, req):
+        req.perm.require('FILEBIFF_MATCH')
+        reponame = req.args.get('repos') or ''
+        if reponame == DEFAULT_REPOSITORY:
+            reponame = ''
+
+        counter = [0]
+
+        def count(paths):
+            for path in paths:
+                counter[0] += 1
+                yield path
+
+        paths = count(iter_lines(req))
+        listener = ChangefileBiffRepositoryChangeListener(self.env)
+        try:
+            biffs = listener.match_paths(reponame, paths)
+            # read the rest of the body even if all biffs are matched
+            for __ in paths:
+                pass
+        except UnicodeDecodeError:
+            raise HTTPBadRequest(_('The paths must be encoded in UTF-8.'))
+        content = json.dumps({
+            'biffs': [{'name': name, 'cc': cc} for name, cc in biffs],
+            'cc': sorted(set(user for __, cc in biffs for user in cc)),
+            'paths': counter[0],
+        }, sort_keys=True)
+        req.send(content, 'application/json')
+
+
+def iter_lines(req):
+    """Yield the stripped non-empty lines of the request body without
+    reading the whole of it into memory.
+    """
+    length = int(req.get_header('Content-Length') or 0)
+    remaining = ''
+    while length > 0:
+        data = req.read(min(length, READ_SIZE))
+        if not data:
+            break
+        length -= len(data)
+        lines = (remaining + data).split('\n')
+        remaining = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line:
+                yield line.decode('utf-8')
+    remaining = remaining.strip()
+    if remaining:
+        yield remaining.decode('utf-8')
@@ -82,6 +82,7 @@ setup(
             'changefilebiff.admin = changefilebiff.admin',
             'changefilebiff.api = changefilebiff.api',
             'changefilebiff.model = changefilebiff.model',
+            'changefilebiff.web_ui = changefilebiff.web_ui',
         ]
     },
     **EXTRA_PARAMETER